@@ -1,20 +1,27 @@
 
 
+import heapq
+
 UNDEC = 0
 IN = 1
 OUT = 2
 
+SEMANTICS = ["grounded", "complete", "preferred", "stable"]
+
 
 class AF:
 
     def __init__(self):
         self.arguments = []  # List of arguments
+        self.argument_set = set()  # same arguments, for membership tests
         self.attacks = []
+        self.attack_set = set()
         self.attacked_by = {}
         self.attacking = {}
         
     def addArgument(self, argument):
-        if argument not in self.arguments:
+        if argument not in self.argument_set:
+            self.argument_set.add(argument)
             self.arguments.append(argument)
 
     def addAttack(self, attacker, attacked=None):
@@ -22,10 +29,11 @@ class AF:
             attacked = attacker[1]
             attacker = attacker[0]
 
-        if (attacker, attacked) in self.attacks:
+        if (attacker, attacked) in self.attack_set:
             raise ValueError(f"Attack from '{attacker}' to '{attacked}' already exists.")
         
         self.attacks.append((attacker, attacked))
+        self.attack_set.add((attacker, attacked))
 
         # update the attacked_by and attacking dicts
         if attacker not in self.attacked_by:
@@ -52,45 +60,238 @@ class AF:
         return []
     
     def computeExtension(self, extension):
-        ext = []
+        # single extension: the grounded one, or the sceptically accepted
+        # arguments for the semantics that can have several extensions
         if extension == "grounded":
-            # Compute grounded extension
-            ext = self.groundedExtension()
+            return self.groundedExtension()
+        extensions = self.computeExtensions(extension)
+        if not extensions:
+            return []
+        common = set(extensions[0]).intersection(*extensions[1:])
+        return [arg for arg in self.arguments if arg in common]
+
+    def computeExtensions(self, extension):
+        if extension == "grounded":
+            return [self.groundedExtension()]
+        elif extension == "complete":
+            return self.completeExtensions()
         elif extension == "preferred":
-            # Compute preferred extension
-            ext = self.preferredExtension()
-        return ext
+            return self.preferredExtensions()
+        elif extension == "stable":
+            return self.stableExtensions()
+        raise ValueError(f"Unknown semantics: {extension}. Known semantics: {SEMANTICS}")
     
-    def getRootArguments(self, status):
-        # Get arguments that are not attacked by any other argument which is IN or UNDEC
-        root_args = []
+    def groundedLabelling(self):
+        # worklist labelling, O(|arguments| + |attacks|)
+        # each argument counts its attackers that are not OUT yet
+        status = {}
+        undefeated = {}
+        worklist = []
         for arg in self.arguments:
+            status[arg] = UNDEC
+            undefeated[arg] = sum(1 for attacker in self.getInAttack(arg) if attacker in self.argument_set)
+            if undefeated[arg] == 0:
+                worklist.append(arg)
+
+        while worklist:
+            arg = worklist.pop()
             if status[arg] != UNDEC:
                 continue
-            attacked_by = self.getInAttack(arg)
-            if all(status[attacker] == OUT for attacker in attacked_by):
-                root_args.append(arg)
-        return root_args
+            status[arg] = IN
+            for attacked in self.getOutAttack(arg):
+                if attacked not in self.argument_set or status[attacked] != UNDEC:
+                    continue
+                status[attacked] = OUT
+                for target in self.getOutAttack(attacked):
+                    if target in self.argument_set:
+                        undefeated[target] -= 1
+                        if undefeated[target] == 0 and status[target] == UNDEC:
+                            worklist.append(target)
+        return status
 
     def groundedExtension(self):
-        # Placeholder for grounded extension computation
-        status = {}
-        for arg in self.arguments:
-            status[arg] = UNDEC
+        status = self.groundedLabelling()
+        return [arg for arg in self.arguments if status[arg] == IN]
+    
+    def getInArguments(self, labels):
+        return [arg for arg in self.arguments if labels[arg] == IN]
 
-        roots = self.getRootArguments(status)
-        while len(roots) > 0:
-            for arg in roots:
-                status[arg] = IN
-                for attacked in self.getOutAttack(arg):
-                    status[attacked] = OUT
-            roots = self.getRootArguments(status)
+    def completeExtensions(self):
+        return [self.getInArguments(labels) for labels in self.searchLabellings()]
 
-        return [arg for arg, stat in status.items() if stat == IN]
-    
-    def preferredExtension(self):
-        # Placeholder for preferred extension computation
-        return []
+    def stableExtensions(self):
+        return [self.getInArguments(labels) for labels in self.searchLabellings(stable=True)]
+
+    def preferredExtensions(self):
+        # complete labellings with a maximal IN set
+        # a branch is pruned when all its possible IN arguments are already IN in a found extension
+        found = []
+        for labels in self.searchLabellings(prune=lambda labels: self.isDominated(labels, found)):
+            ext = set(arg for arg in self.arguments if labels[arg] == IN)
+            found = [other for other in found if not other < ext]
+            if not any(ext <= other for other in found):
+                found.append(ext)
+        return [[arg for arg in self.arguments if arg in ext] for ext in found]
+
+    def isDominated(self, labels, extensions):
+        possible = set(arg for arg in self.arguments if labels[arg] == IN or labels[arg] is None)
+        return any(possible <= ext for ext in extensions)
+
+    def initialLabelling(self):
+        # the grounded IN and OUT arguments have the same label in every complete labelling
+        # None marks the arguments left to label
+        labels = self.groundedLabelling()
+        for arg in labels:
+            if labels[arg] == UNDEC:
+                labels[arg] = None
+        return labels
+
+    def assign(self, labels, arg, label, queue, stable):
+        if stable and label == UNDEC:
+            return False
+        labels[arg] = label
+        queue.append(arg)
+        queue.extend(attacked for attacked in self.getOutAttack(arg) if attacked in self.argument_set)
+        return True
+
+    def propagate(self, labels, queue, stable=False):
+        # enforce the complete labelling rules around the queued arguments:
+        # IN iff all attackers are OUT, OUT iff an attacker is IN, UNDEC otherwise
+        # returns False when the labels cannot be completed
+        while queue:
+            arg = queue.pop()
+            n_in = 0
+            n_undec = 0
+            unlabelled = []
+            for attacker in self.getInAttack(arg):
+                if attacker not in self.argument_set:
+                    continue
+                if labels[attacker] == IN:
+                    n_in += 1
+                elif labels[attacker] == UNDEC:
+                    n_undec += 1
+                elif labels[attacker] is None:
+                    unlabelled.append(attacker)
+
+            label = labels[arg]
+            required = None
+            if n_in > 0:
+                required = OUT
+            elif not unlabelled:
+                required = UNDEC if n_undec > 0 else IN
+            if required is not None:
+                if label is None:
+                    if not self.assign(labels, arg, required, queue, stable):
+                        return False
+                elif label != required:
+                    return False
+                continue
+
+            # no attacker is IN yet, and some are still unlabelled
+            if label == IN:
+                for attacker in unlabelled:
+                    if not self.assign(labels, attacker, OUT, queue, stable):
+                        return False
+            elif label == OUT and len(unlabelled) == 1:
+                if not self.assign(labels, unlabelled[0], IN, queue, stable):
+                    return False
+            elif label == UNDEC and n_undec == 0 and len(unlabelled) == 1:
+                if not self.assign(labels, unlabelled[0], UNDEC, queue, stable):
+                    return False
+        return True
+
+    def searchLabellings(self, stable=False, fixed={}, prune=None):
+        # backtracking over the labels of the arguments left undecided by the grounded labelling
+        # yields every complete (or stable) labelling agreeing with 'fixed'
+        labels = self.initialLabelling()
+        queue = []
+        for arg, label in fixed.items():
+            if arg not in self.argument_set:
+                return
+            if labels[arg] is None:
+                if not self.assign(labels, arg, label, queue, stable):
+                    return
+            elif labels[arg] != label:
+                return
+        if not self.propagate(labels, queue, stable):
+            return
+
+        # most attacked arguments first, they constrain the most
+        order = sorted((arg for arg in self.arguments if labels[arg] is None),
+                       key=lambda arg: -len(self.getInAttack(arg)) - len(self.getOutAttack(arg)))
+        choices = (IN, OUT) if stable else (IN, OUT, UNDEC)
+        stack = [labels]
+        while stack:
+            labels = stack.pop()
+            if prune is not None and prune(labels):
+                continue
+            arg = next((arg for arg in order if labels[arg] is None), None)
+            if arg is None:
+                yield labels
+                continue
+            # reversed so that IN is explored first
+            for label in reversed(choices):
+                child = dict(labels)
+                if self.assign(child, arg, label, queue, stable) and self.propagate(child, queue, stable):
+                    stack.append(child)
+                queue.clear()
+
+    def ancestorAF(self, arg):
+        # sub-AF of the arguments with an attack path to arg
+        # grounded, complete and preferred labels of arg only depend on it (directionality)
+        ancestors = set([arg])
+        worklist = [arg]
+        while worklist:
+            for attacker in self.getInAttack(worklist.pop()):
+                if attacker in self.argument_set and attacker not in ancestors:
+                    ancestors.add(attacker)
+                    worklist.append(attacker)
+        af = AF()
+        for a in self.arguments:
+            if a in ancestors:
+                af.addArgument(a)
+        for attacker, attacked in self.attacks:
+            if attacker in ancestors and attacked in ancestors:
+                af.addAttack(attacker, attacked)
+        return af
+
+    def isCredulouslyAccepted(self, arg, semantics="preferred"):
+        if semantics == "grounded":
+            return arg in self.groundedExtension()
+        if semantics in ("complete", "preferred"):
+            # any complete extension containing arg extends to a preferred one
+            af = self.ancestorAF(arg) if arg in self.argument_set else self
+            return next(af.searchLabellings(fixed={arg: IN}), None) is not None
+        if semantics == "stable":
+            return next(self.searchLabellings(stable=True, fixed={arg: IN}), None) is not None
+        raise ValueError(f"Unknown semantics: {semantics}. Known semantics: {SEMANTICS}")
+
+    def isSkepticallyAccepted(self, arg, semantics="preferred"):
+        if arg not in self.argument_set:
+            return False
+        if semantics in ("grounded", "complete"):
+            # the grounded extension is the intersection of the complete ones
+            return self.groundedLabelling()[arg] == IN
+        if semantics == "stable":
+            # an argument outside a stable extension is OUT
+            # note: vacuously accepted when there is no stable extension
+            return next(self.searchLabellings(stable=True, fixed={arg: OUT}), None) is None
+        if semantics == "preferred":
+            af = self.ancestorAF(arg)
+            labels = af.initialLabelling()
+            if labels[arg] is not None:
+                return labels[arg] == IN
+            if not af.isCredulouslyAccepted(arg, "preferred"):
+                return False
+            return all(arg in ext for ext in af.preferredExtensions())
+        raise ValueError(f"Unknown semantics: {semantics}. Known semantics: {SEMANTICS}")
+
+    def isAccepted(self, arg, semantics="grounded", acceptance="skeptical"):
+        if acceptance == "skeptical":
+            return self.isSkepticallyAccepted(arg, semantics)
+        if acceptance == "credulous":
+            return self.isCredulouslyAccepted(arg, semantics)
+        raise ValueError(f"Unknown acceptance: {acceptance}. Expected 'skeptical' or 'credulous'")
     
     def getStatus(self, value):
         if value == IN:
@@ -110,4 +311,146 @@ class AF:
 
     def print(self):
         print("Arguments:", self.arguments)
-        print("Attacks:", self.attacks)
\ No newline at end of file
+        print("Attacks:", self.attacks)
+
+
+class IncrementalGrounded:
+    # grounded labelling of the active arguments of a fixed attack graph
+    # arguments are bits, given as (bit, attackers mask) pairs
+    # the graph is split once into strongly connected components in topological order,
+    # and update() only relabels the components whose activation or upstream labels changed
+
+    def __init__(self, arguments):
+        self.arguments = list(arguments)
+        self.active = 0
+        self.inn = 0  # IN arguments among the active ones
+        self.out = 0  # OUT arguments among the active ones
+        self.components = []  # [mask, [(bit, attackers mask)], downstream components]
+        self.component_of = {}  # bit -> component position
+        self.decompose()
+
+    @classmethod
+    def fromAF(cls, af):
+        # one bit per argument, in the order of af.arguments
+        index = {arg: 1 << i for i, arg in enumerate(af.arguments)}
+        arguments = []
+        for arg in af.arguments:
+            attackers = 0
+            for attacker in af.getInAttack(arg):
+                attackers |= index.get(attacker, 0)
+            arguments.append((index[arg], attackers))
+        return cls(arguments), index
+
+    def decompose(self):
+        # iterative Tarjan, on the edges attacker -> attacked
+        nodes = [bit for bit, attackers in self.arguments]
+        position = {bit: i for i, bit in enumerate(nodes)}
+        successors = [[] for _ in nodes]
+        for j, (bit, attackers) in enumerate(self.arguments):
+            while attackers:
+                attacker = attackers & -attackers
+                attackers ^= attacker
+                if attacker in position:
+                    successors[position[attacker]].append(j)
+
+        order = [None] * len(nodes)
+        low = [0] * len(nodes)
+        on_stack = [False] * len(nodes)
+        stack = []
+        found = []  # components, sinks first
+        counter = 0
+        for root in range(len(nodes)):
+            if order[root] is not None:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, k = work.pop()
+                if k == 0:
+                    order[node] = low[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack[node] = True
+                if k < len(successors[node]):
+                    work.append((node, k + 1))
+                    nxt = successors[node][k]
+                    if order[nxt] is None:
+                        work.append((nxt, 0))
+                    elif on_stack[nxt]:
+                        low[node] = min(low[node], order[nxt])
+                    continue
+                if low[node] == order[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component.append(member)
+                        if member == node:
+                            break
+                    found.append(component)
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+
+        for c, component in enumerate(reversed(found)):
+            mask = 0
+            for i in component:
+                mask |= nodes[i]
+                self.component_of[nodes[i]] = c
+            self.components.append([mask, [self.arguments[i] for i in sorted(component)], set()])
+        for i, bit in enumerate(nodes):
+            for j in successors[i]:
+                c = self.component_of[bit]
+                d = self.component_of[nodes[j]]
+                if c != d:
+                    self.components[c][2].add(d)
+
+    def relabel(self, c):
+        # grounded labelling inside one component, the upstream labels being final
+        mask, members, downstream = self.components[c]
+        active = self.active
+        inn = self.inn & ~mask
+        out = self.out & ~mask
+        changed = True
+        while changed:
+            changed = False
+            for bit, attackers in members:
+                if not active & bit or (inn | out) & bit:
+                    continue
+                attackers &= active
+                if attackers & inn:
+                    out |= bit
+                    changed = True
+                elif not attackers & ~out:
+                    inn |= bit
+                    changed = True
+        updated = (inn & mask) != (self.inn & mask) or (out & mask) != (self.out & mask)
+        self.inn = inn
+        self.out = out
+        return updated
+
+    def update(self, active):
+        # returns the mask of the grounded extension
+        changed = active ^ self.active
+        if not changed:
+            return self.inn
+        self.active = active
+        queue = []
+        queued = set()
+        while changed:
+            bit = changed & -changed
+            changed ^= bit
+            c = self.component_of.get(bit)
+            if c is not None and c not in queued:
+                queued.add(c)
+                heapq.heappush(queue, c)
+        # the components whose activation changed always notify downstream,
+        # as an argument becoming inactive can free its targets without changing its label
+        activated = set(queued)
+        while queue:
+            c = heapq.heappop(queue)
+            if self.relabel(c) or c in activated:
+                for d in self.components[c][2]:
+                    if d not in queued:
+                        queued.add(d)
+                        heapq.heappush(queue, d)
+        return self.inn
@@ -0,0 +1,326 @@
+# Benchmarks of the runs of the presets and of the hot paths of a training step
+# the results are saved as JSON, and compared to the ones of a previous commit to report the regressions
+# usage: python src/benchmark.py --output bench.json [--baseline previous.json --threshold 0.2]
+
+from af import AF
+from environment import Environment
+from pinocchio import ConstitutiveNorm, DQNAgent, RegulativeNorm, Stakeholder
+from qagent import QAgent, STORAGES, UPDATE_METHODS
+from qtable import SELECTION_METHODS
+from runner import seedAll, setSteps
+import random as rd
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+
+PRESETS = ["taxi", "mini_taxi", "pacman", "adam"]
+DQN_PRESETS = ["taxi"]  # need the torch DQN agent, skipped when it is not installed
+# each benchmark keeps its best round: the noise of a shared machine only slows the rounds down, and many
+# short rounds are more likely to have one that was not interrupted than a few long ones
+ROUNDS = 15
+MIN_TIME = 0.01  # seconds, minimum duration of a round of a micro-benchmark
+GROUPS = ["run", "judge", "closure", "grounded", "select", "update"]
+
+TAXI_ACTIONS = [(movement, speed) for movement in ["up", "down", "left", "right"] for speed in ["slow", "fast"]]
+
+
+def timeit(fun, repeat, rounds=ROUNDS, min_time=MIN_TIME):
+    # mean duration of a call, in microseconds, best of the rounds
+    # a round makes the calls by batches of repeat until it lasted min_time, short calls are timed over many
+    durations = []
+    for _ in range(rounds):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            for _ in range(repeat):
+                fun()
+            calls += repeat
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        durations.append(elapsed / calls * 1e6)
+    return min(durations)
+
+
+def getPresets(presets):
+    # the presets that can run here, the DQN ones need the optional dqn_agent module
+    if DQNAgent is not None:
+        return list(presets)
+    skipped = [preset for preset in presets if preset in DQN_PRESETS]
+    if skipped:
+        print(f"Skipping {skipped}: the DQN agent is not installed", file=sys.stderr)
+    return [preset for preset in presets if preset not in DQN_PRESETS]
+
+
+def makeQAgent(storage="dict", states=10000, preferences=["V", "R"], actions=TAXI_ACTIONS, seed=0):
+    # agent whose Q-functions were updated on random transitions between the given number of states
+    rd.seed(seed)
+    agent = QAgent("bench", storage)
+    agent.setActions(actions)
+    for q in preferences:
+        agent.addQFunction(q)
+    for state in range(states):
+        for action in actions:
+            for q in preferences:
+                agent.updateQValue(q, state, action, rd.choice([-1, 0, 1]), rd.randrange(states))
+    return agent
+
+
+def benchSelection(states=10000, repeat=500, rounds=ROUNDS):
+    # cost of one action selection, per storage and selection method
+    results = {}
+    for storage in STORAGES:
+        agent = makeQAgent(storage, states)
+        queries = [rd.randrange(states) for _ in range(repeat)]
+        for method in SELECTION_METHODS:
+            agent.selection_method = method
+            it = itertools.cycle(queries)
+            results[f"select_{method}_{storage}"] = timeit(lambda: agent.selectBestAction(next(it)), repeat, rounds)
+    return results
+
+
+def benchBatchSelection(states=10000, batch=1024, repeat=2, rounds=ROUNDS):
+    # cost per state of selectBestActions on batches of states, array storage
+    results = {}
+    agent = makeQAgent("array", states)
+    batches = [[rd.randrange(states) for _ in range(batch)] for _ in range(repeat)]
+    for method in SELECTION_METHODS:
+        agent.selection_method = method
+        it = itertools.cycle(batches)
+        results[f"select_batch_{method}_array"] = timeit(lambda: agent.selectBestActions(next(it)), repeat, rounds) / batch
+    return results
+
+
+def benchUpdate(states=10000, repeat=500, rounds=ROUNDS):
+    # cost of the updates of one step, per storage and update method, with and without eligibility traces
+    results = {}
+    for storage in STORAGES:
+        agent = makeQAgent(storage, states)
+        transitions = [(rd.randrange(states), rd.choice(TAXI_ACTIONS), {"V": rd.choice([-1, 0]), "R": -1},
+                        rd.randrange(states)) for _ in range(repeat)]
+        for method in UPDATE_METHODS:
+            for trace_decay in [0, 0.8]:
+                if method == "sequential" and trace_decay:
+                    continue  # eligibility traces always use the batched update
+                agent.update_method = method
+                agent.trace_decay = trace_decay
+                agent.explored = False
+                agent.traces = {}
+                it = itertools.cycle(transitions)
+                name = f"update_{method}{'_traces' if trace_decay else ''}_{storage}"
+                results[name] = timeit(lambda: agent.updateQFunctions(*next(it)), repeat, rounds)
+    return results
+
+
+def benchRun(presets=PRESETS, steps=1000, seed=0, rounds=5):
+    # cost of a step of Environment.run, per preset, while learning then with the learned agent frozen
+    # as the training and testing phases of main.py, each round trains a new agent
+    durations = {}
+    for preset in getPresets(presets):
+        for _ in range(rounds):
+            seedAll(seed)
+            env = Environment()
+            env.loadPreset(preset)
+            setSteps(env, steps)
+            for learning in [True, False]:
+                env.setLearning(learning)
+                env.loadPreset(preset, reset_agent=False)
+                with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                    start = time.perf_counter()
+                    env.run(display=False, run_title="Benchmark")
+                    duration = time.perf_counter() - start
+                # the last episode is finished after the steps, the run may be a bit longer
+                name = f"run_{preset}_{'learning' if learning else 'frozen'}"
+                durations.setdefault(name, []).append(duration / env.metrics.steps * 1e6)
+    return {name: min(values) for name, values in durations.items()}
+
+
+def benchJudge(presets=PRESETS, repeat=500, seed=0, rounds=ROUNDS):
+    # cost of Pinocchio.judge on the states reached by random actions, compiled and with the AFs built at
+    # each call (judgeAF), per preset, each round replays the same actions
+    results = {}
+    for preset in getPresets(presets):
+        seedAll(seed)
+        env = Environment()
+        env.loadPreset(preset)
+        agent = env.agents[-1]
+        actions = env.getActions()
+        for mode in ["compiled", "af"]:
+            if mode == "compiled":
+                agent.compile()
+            else:
+                agent.invalidate()
+                agent.recompile = False  # stays on judgeAF
+            durations = []
+            for _ in range(rounds):
+                rd.seed(seed)
+                env.loadPreset(preset, reset_agent=False)
+                env.iterations = 0
+                duration = 0
+                for _ in range(repeat):
+                    action = rd.choice(actions)
+                    agent.setLastAction(action)
+                    signals, flags, global_flags = env.doAction(agent, action)
+                    flags = env.mergeFlags(flags, global_flags)
+                    state = env.getStateDict(1)
+                    start = time.perf_counter()
+                    agent.judge(state, flags)
+                    duration += time.perf_counter() - start
+                    env.iterations += 1
+                    if env.iterations >= env.timeout or "end" in global_flags:
+                        env.loadPreset(preset, reset_agent=False)
+                        env.iterations = 0
+                durations.append(duration / repeat * 1e6)
+            results[f"judge_{mode}_{preset}"] = min(durations)
+    return results
+
+
+def makeStakeholder(norms=1, facts=100, seed=0):
+    # stakeholder whose c-norms chain facts f0 -> f1 -> ... with random shortcuts, and the facts starting
+    # the closures, for each of its norms
+    rd.seed(seed)
+    stakeholder = Stakeholder("bench")
+    rnorms = [RegulativeNorm("F", [f"n{k}"]) for k in range(norms)]
+    for rnorm in rnorms:
+        stakeholder.addNorm(rnorm)
+        cnorms = [ConstitutiveNorm(f"f{i}", f"f{i + 1}") for i in range(facts - 1)]
+        cnorms += [ConstitutiveNorm([f"f{i}", f"f{rd.randrange(facts)}"], f"f{rd.randrange(facts)}")
+                   for i in range(facts)]
+        stakeholder.setConstitutiveNorms(rnorm, cnorms)
+    brute = [f"f{i}" for i in rd.sample(range(facts), max(1, facts // 10))]
+    return stakeholder, rnorms, brute
+
+
+def benchClosure(sizes=[10, 100, 1000], repeat=None, rounds=ROUNDS):
+    # cost of Stakeholder.closure, per number of facts of its c-norms
+    results = {}
+    for facts in sizes:
+        stakeholder, rnorms, brute = makeStakeholder(1, facts)
+        stakeholder.closure(rnorms[0], brute)  # builds the closure network
+        n = repeat or max(1, 1000 // facts)
+        results[f"closure_{facts}"] = timeit(lambda: stakeholder.closure(rnorms[0], brute), n, rounds)
+    return results
+
+
+def makeAF(arguments=100, attacks=2, seed=0):
+    # random AF with about the given number of attacks per argument
+    rd.seed(seed)
+    af = AF()
+    for i in range(arguments):
+        af.addArgument(f"a{i}")
+    for attack in {(rd.randrange(arguments), rd.randrange(arguments)) for _ in range(arguments * attacks)}:
+        af.addAttack(f"a{attack[0]}", f"a{attack[1]}")
+    return af
+
+
+def benchGrounded(sizes=[10, 100, 1000, 10000], repeat=None, rounds=ROUNDS):
+    # cost of AF.groundedExtension, per number of arguments
+    results = {}
+    for arguments in sizes:
+        af = makeAF(arguments)
+        n = repeat or max(1, 1000 // arguments)
+        results[f"grounded_{arguments}"] = timeit(af.groundedExtension, n, rounds)
+    return results
+
+
+def getCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(results, path):
+    # results: name -> microseconds per call (per step for the runs), saved with the commit and the machine
+    with open(path, 'w') as file:
+        json.dump({"commit": getCommit(), "python": platform.python_version(), "machine": platform.platform(),
+                   "time": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}, file, indent=2)
+
+
+def load(path):
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def compare(baseline, results, threshold=0.2, floor=1.0):
+    # benchmarks slower than in the baseline by more than the threshold (0.2: 20%), slowest first
+    # floor: microseconds, smaller slowdowns are within the noise of the short benchmarks
+    regressions = []
+    for name, us in results.items():
+        before = baseline.get(name)
+        if before and us / before - 1 > threshold and us - before > floor:
+            regressions.append({"name": name, "baseline": before, "value": us, "change": us / before - 1})
+    return sorted(regressions, key=lambda regression: -regression["change"])
+
+
+def formatResult(name, us):
+    if name.startswith("run_"):
+        return f"{name}: {1e6 / us:.0f} steps/s ({us:.1f} us/step)"
+    return f"{name}: {us:.2f} us"
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the runs and of the hot paths of Pinocchio.")
+    parser.add_argument("--groups", nargs="+", default=GROUPS, choices=GROUPS)
+    parser.add_argument("--presets", nargs="+", default=PRESETS)
+    parser.add_argument("--steps", type=int, default=1000, help="steps of each benchmarked run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="save the results there, as JSON")
+    parser.add_argument("--baseline", default=None, help="results of a previous commit, saved with --output")
+    parser.add_argument("--rounds", type=int, default=None, help="rounds of each benchmark, the best one is kept")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown reported as a regression")
+    parser.add_argument("--floor", type=float, default=1.0, help="microseconds, smaller slowdowns are ignored")
+    parser.add_argument("--confirm", type=int, default=2, help="measures again the regressions, that many times")
+    args = parser.parse_args()
+
+    rounds = {} if args.rounds is None else {"rounds": args.rounds}  # the defaults of each benchmark otherwise
+    benchmarks = {
+        "run": lambda: benchRun(args.presets, args.steps, args.seed, **rounds),
+        "judge": lambda: benchJudge(args.presets, seed=args.seed, **rounds),
+        "closure": lambda: benchClosure(**rounds),
+        "grounded": lambda: benchGrounded(**rounds),
+        "select": lambda: {**benchSelection(**rounds), **benchBatchSelection(**rounds)},
+        "update": lambda: benchUpdate(**rounds),
+    }
+    results = {}
+    groups = {}  # benchmark -> its group
+    for group in args.groups:
+        for name, us in benchmarks[group]().items():
+            results[name] = us
+            groups[name] = group
+            print(formatResult(name, us))
+
+    regressions = []
+    if args.baseline is not None:
+        baseline = load(args.baseline)
+        regressions = compare(baseline["results"], results, args.threshold, args.floor)
+        for _ in range(args.confirm):
+            # a slow period of the machine is not a regression: the groups of the regressions are measured
+            # again and their best results kept, only the regressions found every time are reported
+            if not regressions:
+                break
+            print(f"Measuring again {len(regressions)} regressions")
+            for group in dict.fromkeys(groups[regression["name"]] for regression in regressions):
+                for name, us in benchmarks[group]().items():
+                    results[name] = min(results[name], us)
+            regressions = compare(baseline["results"], results, args.threshold, args.floor)
+
+    if args.output is not None:
+        save(results, args.output)
+    if args.baseline is not None:
+        print(f"============== COMPARISON with {baseline.get('commit')} ==============")
+        for regression in regressions:
+            print(f"REGRESSION {formatResult(regression['name'], regression['value'])}, "
+                  f"was {formatResult(regression['name'], regression['baseline']).split(': ', 1)[1]}, "
+                  f"{regression['change'] * 100:+.1f}%")
+        if not regressions:
+            print(f"No regression beyond {args.threshold * 100:.0f}%")
+        sys.exit(1 if regressions else 0)
@@ -1,14 +1,19 @@
 from pinocchio import *
 
+import os
 import time
-import copy as cp
 import random as rd
 import math
+import itertools
 
+import numpy as np
 import matplotlib.pyplot as plt  # type: ignore
 from tqdm import tqdm  # type: ignore
 
 import facts as funfacts
+from runlog import RunLog
+from metrics import RunMetrics
+from profiler import Profiler, section
 
 WALL = 0
 ROAD = 1
@@ -17,6 +22,22 @@ PACMAN = 3
 OBJECT = 4
 RANDOM = 5
 
+VERSIONS = itertools.count(1)  # versions of the state fields, unique across environments
+
+MAX_LABELS = 64  # labels of a cell are stored as a bitset
+
+# movements of the agents, as (dx, dy), in the order of the transition table
+MOVEMENTS = {
+    "up": (0, -1),
+    "down": (0, 1),
+    "left": (-1, 0),
+    "right": (1, 0)
+}
+MOVEMENT_INDEX = {movement: i for i, movement in enumerate(MOVEMENTS)}
+
+SPEED_REWARDS = {"fast": -0.5, "slow": -1}  # reward of each speed in doAction_2
+BUMP_REWARD = -10  # reward for bumping into a wall in doAction_2
+
 
 SYMBOLS = {
     WALL: "#",
@@ -26,28 +47,68 @@ SYMBOLS = {
     RANDOM: "@"
 }
 
+# character of the map files -> cell type, unknown characters are PLAIN
+CHAR_TYPES = np.full(256, PLAIN, dtype=np.int8)
+for cell_type in (WALL, ROAD, PLAIN):
+    CHAR_TYPES[ord(SYMBOLS[cell_type])] = cell_type
+
+
+class StateView:
+    # read-only view of the state given to the facts, indexed like the former state dict
+    # the cell types and the positions are shared with the environment, nothing is copied per step
+    __slots__ = ("grid", "cells", "pos", "objects", "inventory", "iterations", "actions", "override", "versions")
+
+    def __init__(self, grid, cells, pos, objects, inventory, iterations, actions, override, versions):
+        self.grid = grid  # cell types, indexed [y][x] or [y, x]
+        self.cells = cells  # flat cell types, indexed x + y * width
+        self.pos = pos
+        self.objects = objects
+        self.inventory = inventory
+        self.iterations = iterations
+        self.actions = actions
+        self.override = override
+        self.versions = versions
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in StateView.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in StateView.__slots__ else default
+
+    def keys(self):
+        return StateView.__slots__
+
 
 class Cell:
+    # view of one tile of the environment arrays, built on demand by Environment.getCell
 
-    def __init__(self):
-        self.pos = [0, 0]  # [x, y]
-        self.type = PLAIN
+    def __init__(self, env, pos):
+        self.env = env
+        self.pos = pos  # [x, y]
         self.symbol = "?"  # only for objects
-        self.labels = []
+
+    @property
+    def type(self):
+        return int(self.env.types[self.pos[1], self.pos[0]])
 
     def setType(self, type):
-        self.type = type
+        self.env.setCellType(self.pos, type)
 
-    def setPos(self, pos):
-        self.pos = pos
+    @property
+    def labels(self):
+        return self.env.getLabels(self.pos)
 
     def addLabel(self, label):
-        if label not in self.labels:
-            self.labels.append(label)
+        self.env.addLabel(self.pos, label)
 
     def removeLabel(self, label):
-        if label in self.labels:
-            self.labels.remove(label)
+        self.env.removeLabel(self.pos, label)
 
     def getSymbol(self):
         if self.type in SYMBOLS:
@@ -60,7 +121,13 @@ class Environment:
     def __init__(self):
         self.width = 0
         self.height = 0
-        self.grid = []
+        self.types = np.zeros((0, 0), dtype=np.int8)  # type of each cell, indexed [y, x]
+        self.passable = np.zeros((0, 0), dtype=bool)  # cells that are not walls
+        self.labels = np.zeros((0, 0), dtype=np.uint64)  # bitset of the labels of each cell
+        self.label_bits = {}  # label -> bit
+        self.next_cells = np.zeros((0, len(MOVEMENTS)), dtype=np.int32)  # (cell, movement) -> cell reached
+        self.bumps = np.zeros((0, len(MOVEMENTS)), dtype=bool)  # (cell, movement) -> bumped into a wall
+        self.transitions = []  # same table as lists of (x, y, bump), for the action methods
         self.objects = {}
 
         self.stochasticity = 0.1  # probability of random action
@@ -74,6 +141,10 @@ class Environment:
         self.iterations = 0  # number of steps since last reset
 
         self.historic = []
+        self.log_dir = None  # directory of the streaming run logs, see setLogDirectory
+        self.metrics = None  # RunMetrics of the current (or last) run
+        self.early_stop = None  # see setEarlyStop
+        self.profiler = None  # Profiler of the phases of the runs, see enableProfiling
 
         self.doAction = self.doAction_1  # default action method
 
@@ -84,30 +155,102 @@ class Environment:
         self.override_2 = False
         self.override_3 = False
 
+        # bumped whenever the field changes, so that the facts and the state components reading it
+        # know when to be recomputed (code changing an inventory outside of the environment calls touch)
+        self.versions = {"grid": 0, "pos": 0, "objects": 0, "inventory": 0}
+
+        # components of getState, rebuilt only when their version changed
+        self.grid_state = hash(((0, 0), b""))
+        self.state_versions = {}
+        self.pos_state = ()
+        self.objects_state = ()
+        self.inventory_state = ()
+
+        # flat view of the cell types, shared by all the state views
+        self.cell_types = self.types.reshape(-1)
+        # objects and inventories of the state views, copied only when their version changed
+        self.objects_view = {}
+        self.inventory_view = {}
+
+    def touch(self, *fields):
+        for field in fields:
+            self.versions[field] = next(VERSIONS)
+
     def addAgent(self, agent):
         self.agents.append(agent)
         self.pos[agent.name] = [1, 1]  # default position, can be changed later
+        self.touch("pos", "inventory")
 
     def setSize(self, width, height):
-        self.width = width
-        self.height = height
-        self.grid = [[Cell() for _ in range(width)] for _ in range(height)]
-        for y in range(height):
-            for x in range(width):
-                self.grid[y][x].setPos([x, y])
+        self.setTypes(np.full((height, width), PLAIN, dtype=np.int8))
+
+    def setTypes(self, types):
+        self.height, self.width = types.shape
+        self.types = types
+        self.labels = np.zeros(types.shape, dtype=np.uint64)
+        self.indexGrid()
+
+    def indexGrid(self):
+        # to call after changing the types of the cells
+        self.passable = self.types != WALL
+        self.cell_types = self.types.reshape(-1)
+        self.indexMoves()
+        # the map does not change during a run, it is hashed once
+        self.grid_state = hash((self.types.shape, self.types.tobytes()))
+        self.touch("grid")
+
+    def indexMoves(self):
+        # cells are numbered x + y * width, a move blocked by a wall or the border stays on the cell
+        height, width = self.types.shape
+        ys, xs = np.indices((height, width))
+        cells = (xs + ys * width).reshape(-1)
+        padded = np.zeros((height + 2, width + 2), dtype=bool)  # the border is not passable
+        padded[1:-1, 1:-1] = self.passable
+        self.next_cells = np.empty((height * width, len(MOVEMENTS)), dtype=np.int32)
+        self.bumps = np.empty((height * width, len(MOVEMENTS)), dtype=bool)
+        for i, (dx, dy) in enumerate(MOVEMENTS.values()):
+            allowed = padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width].reshape(-1)
+            self.next_cells[:, i] = np.where(allowed, cells + dx + dy * width, cells)
+            self.bumps[:, i] = ~allowed
+        self.transitions = [[(int(cell) % width, int(cell) // width, bool(bump)) for cell, bump in zip(row, bump_row)]
+                            for row, bump_row in zip(self.next_cells.tolist(), self.bumps.tolist())] if width else []
 
     def loadFile(self, filename):
         with open(filename, 'r') as file:
             lines = file.readlines()
-            self.setSize(len(lines[0].strip()), len(lines))
-            for y, line in enumerate(lines):
-                for x, char in enumerate(line.strip()):
-                    if char == SYMBOLS[WALL]:
-                        self.grid[y][x].setType(WALL)
-                    elif char == SYMBOLS[ROAD]:
-                        self.grid[y][x].setType(ROAD)
-                    elif char == SYMBOLS[PLAIN]:
-                        self.grid[y][x].setType(PLAIN)
+        types = np.full((len(lines), len(lines[0].strip())), PLAIN, dtype=np.int8)
+        for y, line in enumerate(lines):
+            chars = np.frombuffer(line.strip().encode(), dtype=np.uint8)
+            types[y, :len(chars)] = CHAR_TYPES[chars]
+        self.setTypes(types)
+
+    def getCell(self, pos):
+        return Cell(self, pos)
+
+    def setCellType(self, pos, type):
+        self.types[pos[1], pos[0]] = type
+        self.indexGrid()
+
+    def getLabelBit(self, label):
+        if label not in self.label_bits:
+            if len(self.label_bits) >= MAX_LABELS:
+                raise ValueError(f"Too many labels, at most {MAX_LABELS} are supported.")
+            self.label_bits[label] = np.uint64(1 << len(self.label_bits))
+        return self.label_bits[label]
+
+    def addLabel(self, pos, label):
+        self.labels[pos[1], pos[0]] |= self.getLabelBit(label)
+
+    def removeLabel(self, pos, label):
+        if label in self.label_bits:
+            self.labels[pos[1], pos[0]] &= ~self.label_bits[label]
+
+    def hasLabel(self, pos, label):
+        return label in self.label_bits and bool(self.labels[pos[1], pos[0]] & self.label_bits[label])
+
+    def getLabels(self, pos):
+        bits = self.labels[pos[1], pos[0]]
+        return [label for label, bit in self.label_bits.items() if bits & bit]
 
     def loadPreset(self, presetName, reset_agent=True):
         self.loadedPreset = presetName
@@ -119,6 +262,7 @@ class Environment:
             self.loadAdam(reset_agent)
         elif presetName == "mini_taxi":
             self.loadMiniTaxi(reset_agent)
+        self.touch("grid", "pos", "objects", "inventory")
 
     def loadMiniTaxi(self, reset_agent=True):
 
@@ -160,18 +304,18 @@ class Environment:
 
             # facts
             taxi.addFact("pavement", lambda state, flags:
-                state["grid"][state["pos"]["Taxi"][1]][state["pos"]["Taxi"][0]] == PLAIN)
+                state["grid"][state["pos"]["Taxi"][1]][state["pos"]["Taxi"][0]] == PLAIN, ["grid", "pos"])
             taxi.addFact("road", lambda state, flags:
-                state["grid"][state["pos"]["Taxi"][1]][state["pos"]["Taxi"][0]] == ROAD)
-            taxi.addFact("speeding", lambda state, flags: state["actions"].get(taxi.name)[1] == "fast")
-            taxi.addFact("stop", lambda state, flags: "pick" in flags or "drop" in flags)
-            taxi.addFact("role(taxi)", lambda state, flags: True)
-            taxi.addFact("has_passenger", lambda state, flags: "passenger" in state["inventory"][taxi.name])
-            taxi.addFact("time_0-5", lambda state, flags: state["iterations"] <= 5)
-            taxi.addFact("time_6-7", lambda state, flags: 5 < state["iterations"] <= 7)
-            taxi.addFact("time_8-15", lambda state, flags: 7 < state["iterations"] <= 15)
-            taxi.addFact("time_16-20", lambda state, flags: 15 < state["iterations"] <= 20)
-            taxi.addFact("dist_parking_<_4", funfacts.parking_close)
+                state["grid"][state["pos"]["Taxi"][1]][state["pos"]["Taxi"][0]] == ROAD, ["grid", "pos"])
+            taxi.addFact("speeding", lambda state, flags: state["actions"].get(taxi.name)[1] == "fast", ["actions"])
+            taxi.addFact("stop", lambda state, flags: "pick" in flags or "drop" in flags, ["flags"])
+            taxi.addFact("role(taxi)", lambda state, flags: True, [])
+            taxi.addFact("has_passenger", lambda state, flags: "passenger" in state["inventory"][taxi.name], ["inventory"])
+            taxi.addIntervalFacts("iterations", [("time_0-5", None, 5),
+                                                 ("time_6-7", 5, 7),
+                                                 ("time_8-15", 7, 15),
+                                                 ("time_16-20", 15, 20)])
+            taxi.addFact("dist_parking_<_4", funfacts.parking_close, ["flags", "objects", "pos"])
             # taxi.addFact("in_city", lambda state, flags: True)
 
             attacks_r1 = []
@@ -195,9 +339,9 @@ class Environment:
             taxi_sh.addConstitutiveNorm(r3, ct3)
             taxi_sh.addConstitutiveNorm(r3, ct6)
 
-            taxi_sh.afs[str(r1)] = AF()
-            taxi_sh.afs[str(r2)] = AF()
-            taxi_sh.afs[str(r3)] = AF()
+            taxi_sh.setAF(r1, AF())
+            taxi_sh.setAF(r2, AF())
+            taxi_sh.setAF(r3, AF())
 
             taxi_sh.setArguments(str(r1), [str(r1)])
             taxi_sh.setArguments(str(r2), [str(r2), "no_traffic", "late"])
@@ -212,9 +356,9 @@ class Environment:
             law.addConstitutiveNorm(r2, cl2)
             law.addConstitutiveNorm(r3, cl1)
 
-            law.afs[str(r1)] = AF()
-            law.afs[str(r2)] = AF()
-            law.afs[str(r3)] = AF()
+            law.setAF(r1, AF())
+            law.setAF(r2, AF())
+            law.setAF(r3, AF())
             law.setArguments(str(r1), [str(r1)])
             law.setArguments(str(r2), [str(r2), "no_exception"])
             law.setAttacks(str(r2), attacks_r2)
@@ -223,6 +367,7 @@ class Environment:
 
             taxi.addStakeholder(taxi_sh)
             taxi.addStakeholder(law)
+            taxi.compile()
 
         movements = ["up", "down", "left", "right"]
         speeds = ["slow", "fast"]
@@ -279,7 +424,10 @@ class Environment:
             taxi = Pinocchio("Taxi")
             # taxi.loadOptimalAgent(self.steps)
             # taxi.loadNormativeAgent(self.steps)
-            taxi.loadDQNAgent(self.steps)
+            if DQNAgent is not None:
+                taxi.loadDQNAgent(self.steps)
+            else:
+                taxi.loadNormativeAgent(self.steps)  # the DQN agent is optional, see pinocchio
             self.agents.append(taxi)
             randAgent = Pinocchio("Random")
             randAgent.agent.isRandom = True
@@ -316,22 +464,22 @@ class Environment:
 
             # facts
             taxi.addFact("pavement", lambda state, flags:
-                state["grid"][state["pos"]["Taxi"][1]][state["pos"]["Taxi"][0]] == PLAIN)
+                state["grid"][state["pos"]["Taxi"][1]][state["pos"]["Taxi"][0]] == PLAIN, ["grid", "pos"])
             taxi.addFact("road", lambda state, flags:
-                state["grid"][state["pos"]["Taxi"][1]][state["pos"]["Taxi"][0]] == ROAD)
-            taxi.addFact("speeding", lambda state, flags: state["actions"].get(taxi.name)[1] == "fast")
-            taxi.addFact("stop", lambda state, flags: "pick" in flags or "drop" in flags)
-            taxi.addFact("role(taxi)", lambda state, flags: True)
-            taxi.addFact("has_passenger", lambda state, flags: "passenger" in state["inventory"][taxi.name])
-            taxi.addFact("time_0-10", lambda state, flags: state["iterations"] <= 10)
-            taxi.addFact("time_11-20", lambda state, flags: 10 < state["iterations"] <= 15)
-            taxi.addFact("time_21-30", lambda state, flags: 15 < state["iterations"] <= 30)
-            taxi.addFact("time_31-40", lambda state, flags: 30 < state["iterations"] <= 40)
-            taxi.addFact("time_41-50", lambda state, flags: 40 < state["iterations"] <= 50)
-            taxi.addFact("time_51-60", lambda state, flags: 50 < state["iterations"])
-            taxi.addFact("dist_parking_<_4", funfacts.parking_close)
+                state["grid"][state["pos"]["Taxi"][1]][state["pos"]["Taxi"][0]] == ROAD, ["grid", "pos"])
+            taxi.addFact("speeding", lambda state, flags: state["actions"].get(taxi.name)[1] == "fast", ["actions"])
+            taxi.addFact("stop", lambda state, flags: "pick" in flags or "drop" in flags, ["flags"])
+            taxi.addFact("role(taxi)", lambda state, flags: True, [])
+            taxi.addFact("has_passenger", lambda state, flags: "passenger" in state["inventory"][taxi.name], ["inventory"])
+            taxi.addIntervalFacts("iterations", [("time_0-10", None, 10),
+                                                 ("time_11-20", 10, 15),
+                                                 ("time_21-30", 15, 30),
+                                                 ("time_31-40", 30, 40),
+                                                 ("time_41-50", 40, 50),
+                                                 ("time_51-60", 50, None)])
+            taxi.addFact("dist_parking_<_4", funfacts.parking_close, ["flags", "objects", "pos"])
             # taxi.addFact("in_city", lambda state, flags: True)
-            taxi.addFact("collision", lambda state, flags: "collision" in flags)
+            taxi.addFact("collision", lambda state, flags: "collision" in flags, ["flags"])
 
             attacks_r1 = []
             attacks_r2 = [("late", str(r2)), ("no_traffic", str(r2)), ("no_exception", "late"), ("no_exception", "no_traffic")]
@@ -357,9 +505,9 @@ class Environment:
             taxi_sh.addConstitutiveNorm(r3, ct10)
             taxi_sh.addConstitutiveNorm(r3, ct11)
 
-            taxi_sh.afs[str(r1)] = AF()
-            taxi_sh.afs[str(r2)] = AF()
-            taxi_sh.afs[str(r3)] = AF()
+            taxi_sh.setAF(r1, AF())
+            taxi_sh.setAF(r2, AF())
+            taxi_sh.setAF(r3, AF())
 
             taxi_sh.setArguments(str(r1), [str(r1)])
             taxi_sh.setArguments(str(r2), [str(r2), "no_traffic", "late"])
@@ -378,10 +526,10 @@ class Environment:
             law.addConstitutiveNorm(r3, cl1)
             law.addConstitutiveNorm(r4, cl3)
 
-            law.afs[str(r1)] = AF()
-            law.afs[str(r2)] = AF()
-            law.afs[str(r3)] = AF()
-            law.afs[str(r4)] = AF()
+            law.setAF(r1, AF())
+            law.setAF(r2, AF())
+            law.setAF(r3, AF())
+            law.setAF(r4, AF())
             law.setArguments(str(r1), [str(r1)])
             law.setArguments(str(r2), [str(r2), "no_exception"])
             law.setAttacks(str(r2), attacks_r2)
@@ -391,6 +539,7 @@ class Environment:
 
             taxi.addStakeholder(taxi_sh)
             taxi.addStakeholder(law)
+            taxi.compile()
 
         movements = ["up", "down", "left", "right"]
         speeds = ["slow", "fast"]
@@ -430,6 +579,8 @@ class Environment:
         for i, agent in enumerate(self.agents):
             agent.resetInventory()
             # agent.setActions(actions)
+            if agent.isTabular() and not agent.agent.actions:  # the tabular fallback of the DQN agent
+                agent.setActions(actions)
             agent.setLastAction(None)  # reset last action
             agent.setLastSignal(None)  # reset last signal
             # agent.isRandom = True  # comment this
@@ -472,8 +623,8 @@ class Environment:
             adam.addNorm(r1)
 
             # add fact functions
-            adam.addFact("eat", lambda state, flags: "eat" in flags)
-            adam.addFact("longtime", lambda state, flags: state["iterations"] > 5)
+            adam.addFact("eat", lambda state, flags: "eat" in flags, ["flags"])
+            adam.addIntervalFacts("iterations", [("longtime", 5, None)])
 
             # constitutive norms
             c1 = ConstitutiveNorm("eat", "knowledge")
@@ -484,20 +635,21 @@ class Environment:
             god = Stakeholder("God")
             god.addNorm(r1)
             god.addConstitutiveNorm(r1, c1)
-            god.afs[str(r1)] = AF()
+            god.setAF(r1, AF())
             god.setArguments(str(r1), [str(r1)])
             sh.append(god)
 
             user = Stakeholder("User")
             user.addNorm(r1)
             user.addConstitutiveNorm(r1, c2)
-            user.afs[str(r1)] = AF()
+            user.setAF(r1, AF())
             user.setArguments(str(r1), [str(r1), "hungry"])
             user.setAttacks(str(r1), [("hungry", str(r1))])
             sh.append(user)
 
             for s in sh:
                 adam.addStakeholder(s)
+            adam.compile()
             self.agents.append(adam)
 
         self.objects["apple"] = self.makeObject()
@@ -529,29 +681,71 @@ class Environment:
     def setSteps(self, steps):
         self.steps = steps
 
+    def setLogDirectory(self, path):
+        # opt-in: the steps of the next runs are written to path/run_<id> instead of being kept in memory
+        # None keeps them in memory again
+        self.log_dir = path
+
+    def enableProfiling(self):
+        # opt-in: times the phases of each step, and each norm in the judgements of the agents
+        # the results of a run are in its run_hist["profile"]
+        self.profiler = Profiler()
+        for agent in self.agents:
+            agent.profiler = self.profiler
+
+    def disableProfiling(self):
+        self.profiler = None
+        for agent in self.agents:
+            agent.profiler = None
+
+    def setEarlyStop(self, condition):
+        # condition(metrics): checked at the end of each episode with the RunMetrics of the run, True stops it
+        # None runs all the steps again
+        self.early_stop = condition
+
+    def getActions(self):
+        # actions of the loaded preset, given by its action method
+        if self.doAction == self.doAction_2:
+            return [(movement, speed) for movement in MOVEMENTS for speed in ["slow", "fast"]]
+        return list(MOVEMENTS)
+
     def setPos(self, agent_name, pos):
         if type(agent_name) != str:
             agent_name = agent_name.name
         self.pos[agent_name] = pos
+        self.touch("pos")
 
     def display(self):
-        cp_grid = cp.deepcopy(self.grid)
+        chars = [[SYMBOLS.get(cell_type, "?") for cell_type in row] for row in self.types.tolist()]
         for agent in self.agents:
             pos = self.pos[agent.name]
             typeToSet = PACMAN if not agent.agent.isRandom else RANDOM
-            cp_grid[pos[1]][pos[0]].setType(typeToSet)
+            chars[pos[1]][pos[0]] = SYMBOLS[typeToSet]
         for obj_name, obj in self.objects.items():
             pos = obj["pos"]
-            cp_grid[pos[1]][pos[0]].setType(OBJECT)
-            cp_grid[pos[1]][pos[0]].symbol = obj["symbol"]
-        for row in cp_grid:
-            print("".join(cell.getSymbol() for cell in row))
+            chars[pos[1]][pos[0]] = obj["symbol"]
+        for row in chars:
+            print("".join(row))
 
     def run(self, display=False, run_title=""):
 
         if run_title == "":
             run_title = f"Run {len(self.historic) + 1}"
-        logs = []
+
+        window = self.window
+        if window > self.steps:
+            window = int(self.steps / 20)
+        if self.log_dir is None:
+            logs = []
+        else:
+            logs = RunLog(os.path.join(self.log_dir, f"run_{len(self.historic)}"), window)
+        self.metrics = RunMetrics(window)
+        stopped = False
+        prof = self.profiler
+        if prof is not None:
+            prof.reset()
+            for agent in self.agents:
+                agent.profiler = prof  # agents added after enableProfiling
 
         start_time = time.time()
 
@@ -562,8 +756,6 @@ class Environment:
         if not display:
             pbar = tqdm(total=self.steps, desc=run_title)
 
-        signals_total = {}
-
         print("============== RUN INFO ==============")
         print(f"Run Title: {run_title}")
         print(f"Steps: {self.steps}, Timeout: {self.timeout}")
@@ -578,13 +770,14 @@ class Environment:
             if display and self.iterations == 0:
                 # print("=========VVVVV=========VVVVV=========")
                 pass
-            log, ending = self.step()
-            logs.append(log)
+            with section(prof, "step"):
+                log, ending = self.step()
+            with section(prof, "log"):
+                logs.append(log)
+                self.metrics.update(log, self.agents[-1].getLastViolations())
             reset = False
-            for k, v in log.items():
-                if k not in signals_total:
-                    signals_total[k] = 0
-                signals_total[k] += v
+            if pbar is not None and i % 1000 == 0:
+                pbar.set_postfix({k: round(v, 2) for k, v in self.metrics.getMeans().items()})
             if display:
                 # print(f"Run '{run_title}': Iteration {i + 1}/{self.steps} - Step {self.iterations + 1}/{self.timeout}")
                 for agent in self.agents:
@@ -594,36 +787,47 @@ class Environment:
                 pass
             self.iterations += 1
             if self.iterations >= self.timeout or ending:  # reset the agent every X steps or when "end" flag is triggered
-                self.loadPreset(self.loadedPreset, reset_agent=False)
+                with section(prof, "reset"):
+                    self.loadPreset(self.loadedPreset, reset_agent=False)
                 self.iterations = 0
                 reset = True
+                signals_total = self.metrics.endEpisode()
                 if display:
                     print("Total:", signals_total)
-                signals_total = {}
+                if self.early_stop is not None and self.early_stop(self.metrics):
+                    stopped = True
+                    break
 
         end_time = time.time()
 
-        # movingAverage of the tracked Q-Functions
+        # moving average of the tracked Q-Functions
         evolution = {}
         qfunctions = ['R', 'V']
-        window = self.window
-        if window > self.steps:
-            window = int(self.steps / 20)
         for q in qfunctions:
-            evolution[q] = self.movingAverage([log[q] for log in logs if isinstance(log, dict) and q in log], window)
+            evolution[q] = self.metrics.getCurve(q)
+        if isinstance(logs, RunLog):
+            logs.close(evolution)
 
         run_hist = {}
         run_hist["title"] = run_title
         run_hist["id"] = len(self.historic)
         run_hist["steps"] = self.steps
-        run_hist["logs"] = logs
+        run_hist["logs"] = logs  # list of the signals of each step, or RunLog when streamed
+        if isinstance(logs, RunLog):
+            run_hist["totals"] = logs.totals
+        run_hist["metrics"] = self.metrics.summary()
+        run_hist["stopped"] = stopped  # ended by the early stop condition
         run_hist["evolution"] = evolution
         run_hist["time"] = round(end_time - start_time, 1)
+        if prof is not None:
+            run_hist["profile"] = prof.summary()
+            print(f"Run Title: {run_title}, Time: {run_hist['time']}s")
+            prof.report(run_hist["profile"], end_time - start_time)
         self.historic.append(run_hist)
 
         # self.printRunHistoric(run_hist)
         a = self.agents[-1].agent
-        if True:
+        if hasattr(a, "print_loss_history"):  # only the DQN agent keeps a loss history
             print("Loss:")
             a.print_loss_history(run_title)
 
@@ -645,15 +849,13 @@ class Environment:
         for run in self.historic:
             self.printRunHistoric(run)
 
-    def movingAverage(self, data, window_size):
-        if window_size <= 0:
-            raise ValueError("Window size must be positive")
-        if not data:
-            return []
-        cumsum = [0] * (len(data) + 1)
-        for i, x in enumerate(data):
-            cumsum[i + 1] = cumsum[i] + x
-        return [(cumsum[i + window_size] - cumsum[i]) / window_size for i in range(len(data) - window_size + 1)]
+    def mergeFlags(self, flags, global_flags):
+        # flags of an agent followed by the global flags of the step it does not have, as the agent is judged on them
+        merged = list(flags)
+        for flag in global_flags:
+            if flag not in merged:
+                merged.append(flag)
+        return merged
 
     def step(self):
         all_signals = []
@@ -668,9 +870,12 @@ class Environment:
         self.override_2 = self.override_1
         self.override_1 = False
 
+        prof = self.profiler  # phases timed only when profiling
+
         # sequential
         for agent in self.agents:
-            state = self.getState()
+            with section(prof, "getState"):
+                state = self.getState()
             
             dqn_state = dict()
             dqn_state['index'] = state[1]
@@ -678,7 +883,8 @@ class Environment:
 
             if self.debug:
                 agent.printQFunctions(state)  # print Q-Functions for debugging
-            state_dict = self.getStateDict()
+            with section(prof, "getStateDict"):
+                state_dict = self.getStateDict()
             all_states.append(state)
             all_states_dict.append(state_dict)
             
@@ -686,11 +892,13 @@ class Environment:
             epsilon = epsilon_end + (epsilon_start - epsilon_end) * \
                 math.exp(-1. * (len(self.historic) * self.steps + self.iterations) / epsilon_decay)
 
-            action = agent.getAction(dqn_state, epsilon)
+            with section(prof, "getAction"):
+                action = agent.getAction(state if agent.isTabular() else dqn_state, epsilon)
             agent.setLastAction(action)
             all_actions.append(action)
 
-            signals, flags, gflags = self.doAction(agent, action)
+            with section(prof, "doAction"):
+                signals, flags, gflags = self.doAction(agent, action)
             all_signals.append(signals)
             # print(flags, gflags)
 
@@ -704,25 +912,16 @@ class Environment:
                 self.override_2 = False
                 pass
 
-            next_state = self.getState()
-            next_state_dict = self.getStateDict()
+            with section(prof, "getState"):
+                next_state = self.getState(1)
+            with section(prof, "getStateDict"):
+                next_state_dict = self.getStateDict(1)  # the next state corresponds to the next iteration count
             all_next_states.append(next_state)
             all_next_states_dict.append(next_state_dict)
 
         # append global flags to all agents' flags
-        for gflags in all_gflags:
-            for flag in gflags:
-                for i in range(len(all_flags)):
-                    if flag not in all_flags[i]:
-                        all_flags[i].append(flag)
-
-        # modify here so the next state corresponds to the one with the correct iteration count
-        # print(all_next_states_dict)
-        for i in range(len(all_next_states_dict)):
-            all_next_states_dict[i]["iterations"] += 1
-            tmp = list(all_next_states[i])
-            tmp[-2] = all_next_states_dict[i]["iterations"] // 5
-            all_next_states[i] = tuple(tmp)
+        global_flags = [flag for gflags in all_gflags for flag in gflags]
+        all_flags = [self.mergeFlags(flags, global_flags) for flags in all_flags]
 
         # print(all_next_states)
         for i, agent in enumerate(self.agents):
@@ -742,8 +941,12 @@ class Environment:
             if self.debug_judgement:
                 print("State:",state)
                 # print("Q-Functions:", agent.printQFunctions(state))
-            all_signals[i]['V'] = agent.judge(next_state_dict, all_flags[i], self.debug_judgement)  # judges the consequences
-            agent.updateQFunctions(dqn_state, agent.getLastAction(), all_signals[i]['R'], all_signals[i]['V'], dqn_next_state, "end" in all_gflags[i])
+            with section(prof, "judge"):
+                all_signals[i]['V'] = agent.judge(next_state_dict, all_flags[i], self.debug_judgement)  # judges the consequences
+            if agent.isTabular():
+                dqn_state, dqn_next_state = state, next_state  # tabular agents learn on the full state
+            with section(prof, "updateQFunctions"):
+                agent.updateQFunctions(dqn_state, agent.getLastAction(), all_signals[i]['R'], all_signals[i]['V'], dqn_next_state, "end" in all_gflags[i])
             agent.setLastSignal(all_signals[i])
             agent.clearOverrides()
             agent.override_3 = False
@@ -756,45 +959,42 @@ class Environment:
 
         return all_signals[-1], ending
     
-    def getStateDict(self):
-        state = {}
-
-        state["grid"] = [[cell.type for cell in row] for row in self.grid]
-        state["pos"] = {agent.name: self.pos[agent.name] for agent in self.agents}
-        state["objects"] = {name: obj for name, obj in self.objects.items()}
-        state["inventory"] = {agent.name: agent.getInventory() for agent in self.agents}
-        state["iterations"] = self.iterations
-        state["actions"] = {agent.name: agent.getLastAction() for agent in self.agents}
-        state["override"] = self.override_1 or self.override_2
-
-        return state
-
-    def getState(self):
-        # state of the map
-        grid_state = ""
-        for row in self.grid:
-            grid_state += "".join([str(cell.type) for cell in row])
-        grid_state = hash(grid_state)
-
+    def getStateDict(self, offset=0):
+        # offset: added to the iteration count, for the state reached after the current step
+        if self.versions != self.state_versions:
+            self.refreshState()
+        actions = {agent.name: agent.getLastAction() for agent in self.agents}
+        return StateView(self.types, self.cell_types, self.pos, self.objects_view, self.inventory_view,
+                         self.iterations + offset, actions, self.override_1 or self.override_2, self.state_versions)
+
+    def refreshState(self):
+        # rebuilds the components of the state whose version changed since the last call
+        versions = self.versions
+        last = self.state_versions
         # agent positions
-        agent_pos_state = tuple([pos[0] + pos[1] * self.width for pos in self.pos.values()])
+        if versions["pos"] != last.get("pos"):
+            self.pos_state = tuple([pos[0] + pos[1] * self.width for pos in self.pos.values()])
 
         # inventory
-        agent_inventory = tuple(sorted((agent.name, tuple(agent.getInventory())) for agent in self.agents))
+        if versions["inventory"] != last.get("inventory"):
+            self.inventory_state = tuple(sorted((agent.name, tuple(agent.getInventory())) for agent in self.agents))
+            self.inventory_view = {agent.name: agent.getInventory() for agent in self.agents}
 
         # objects
-        objects_state = tuple(sorted((name, obj["pos"][0] + obj["pos"][1] * self.width)
-                                     for name, obj in self.objects.items()))
-        
-        # iteration
-        iteration_state = self.iterations // 5
-
-        # speeding norm override
-        forbid_speeding = self.override_1 or self.override_2
-
-        # final state
-        state = [grid_state, agent_pos_state, objects_state, agent_inventory, iteration_state, forbid_speeding]
-        return tuple(state)
+        if versions["objects"] != last.get("objects"):
+            self.objects_state = tuple(sorted((name, obj["pos"][0] + obj["pos"][1] * self.width)
+                                              for name, obj in self.objects.items()))
+            self.objects_view = {name: obj for name, obj in self.objects.items()}
+        self.state_versions = dict(versions)
+
+    def getState(self, offset=0):
+        # offset: added to the iteration count, for the state reached after the current step
+        if self.versions != self.state_versions:
+            self.refreshState()
+
+        # map, agent positions, objects, inventory, iteration, speeding norm override
+        return (self.grid_state, self.pos_state, self.objects_state, self.inventory_state,
+                (self.iterations + offset) // 5, self.override_1 or self.override_2)
     
     def setOptimal(self, value):
         for agent in self.agents:
@@ -826,6 +1026,7 @@ class Environment:
         
         agent.addItemsToInventory(obj["inv_add"])
         agent.removeItemsFromInventory(obj["inv_rem"])
+        self.touch("inventory")
         reward += obj["reward"]
         flags.extend(obj["flags"])
         global_flags.extend(obj["global_flags"])
@@ -850,6 +1051,8 @@ class Environment:
                 toRemove.extend(toRemove_p)
         for obj_name in toRemove:
             del self.objects[obj_name]
+        if toRemove:
+            self.touch("objects")
 
         return reward, flags, global_flags
 
@@ -861,22 +1064,13 @@ class Environment:
             possible = ["up", "down", "left", "right"]
             possible.remove(action)
             action = rd.choice(possible)
-        if action == "up":
-            if pos[1] > 0 and self.grid[pos[1] - 1][pos[0]].type != WALL:
-                pos[1] -= 1
-                reward = 0
-        elif action == "down":
-            if pos[1] < self.height - 1 and self.grid[pos[1] + 1][pos[0]].type != WALL:
-                pos[1] += 1
-                reward = 0
-        elif action == "left":
-            if pos[0] > 0 and self.grid[pos[1]][pos[0] - 1].type != WALL:
-                pos[0] -= 1
-                reward = 0
-        elif action == "right":
-            if pos[0] < self.width - 1 and self.grid[pos[1]][pos[0] + 1].type != WALL:
-                pos[0] += 1
+        move = MOVEMENT_INDEX.get(action)
+        if move is not None:
+            x, y, bump = self.transitions[pos[0] + pos[1] * self.width][move]
+            if not bump:
+                pos[0], pos[1] = x, y
                 reward = 0
+                self.touch("pos")
         self.pos[agent.name] = pos
 
         reward_handle, flags, global_flags = self.handleObjectsOnPosition(agent)
@@ -892,39 +1086,24 @@ class Environment:
         movement = action[0]
         speed = action[1]
         
-        if speed == "fast":
-            reward -= 0.5
-        elif speed == "slow":
-            reward -= 1
+        reward += SPEED_REWARDS.get(speed, 0)
         # if not agent.has("passenger"):
         #     reward = 0
         
-        if movement == "up":
-            if pos[1] > 0 and self.grid[pos[1] - 1][pos[0]].type != WALL:
-                pos[1] -= 1
-            else:
-                reward -= 10
-        elif movement == "down":
-            if pos[1] < self.height - 1 and self.grid[pos[1] + 1][pos[0]].type != WALL:
-                pos[1] += 1
-            else:
-                reward -= 10
-        elif movement == "left":
-            if pos[0] > 0 and self.grid[pos[1]][pos[0] - 1].type != WALL:
-                pos[0] -= 1
-            else:
-                reward -= 10
-        elif movement == "right":
-            if pos[0] < self.width - 1 and self.grid[pos[1]][pos[0] + 1].type != WALL:
-                pos[0] += 1
+        move = MOVEMENT_INDEX.get(movement)
+        if move is not None:
+            x, y, bump = self.transitions[pos[0] + pos[1] * self.width][move]
+            if bump:
+                reward += BUMP_REWARD
             else:
-                reward -= 10
+                pos[0], pos[1] = x, y
+                self.touch("pos")
 
         self.pos[agent.name] = pos
 
         reward_handle, flags, global_flags = self.handleObjectsOnPosition(agent)
         reward += reward_handle
-        flags.append("road" if self.grid[pos[1]][pos[0]].type == ROAD else "pavement")
+        flags.append("road" if self.types[pos[1], pos[0]] == ROAD else "pavement")
 
         for other in self.agents:
             if other.name != agent.name and self.pos[other.name] == pos:
@@ -0,0 +1,131 @@
+# Fact extraction used by Pinocchio.epsilon
+# A fact can declare the state fields it reads, it is then only re-evaluated when one of them changes
+# the changes are read from state["versions"] (field -> version bumped on each change), as given by the
+# state views of Environment: for the states without versions, every fact is evaluated at each call
+
+import bisect
+
+STATE_FIELDS = ["grid", "pos", "objects", "inventory", "iterations", "actions", "override", "flags"]
+
+
+# fields changing at almost every step: comparing them costs more than re-evaluating their facts
+VOLATILE_FIELDS = ["iterations", "actions", "override", "flags"]
+
+
+class IntervalFamily:
+    # facts of the form low < state[field] <= high (None is unbounded)
+    # the intervals are disjoint, so one bisection finds the fact that holds
+
+    def __init__(self, field, intervals):
+        if field not in STATE_FIELDS or field == "flags":
+            raise ValueError(f"Unknown state field: {field}. Known fields: {STATE_FIELDS[:-1]}")
+        self.field = field
+        self.intervals = sorted(intervals, key=lambda interval: -float("inf") if interval[1] is None else interval[1])
+        for (name, low, high), (next_name, next_low, next_high) in zip(self.intervals, self.intervals[1:]):
+            if high is None or next_low is None or next_low < high:
+                raise ValueError(f"Intervals of '{name}' and '{next_name}' overlap.")
+        self.names = [name for name, low, high in self.intervals]
+        self.lows = [low for name, low, high in self.intervals]
+        self.highs = [float("inf") if high is None else high for name, low, high in self.intervals]
+
+    def lookup(self, value):
+        # position of the interval containing value, or None
+        i = bisect.bisect_left(self.highs, value)
+        if i < len(self.highs) and (self.lows[i] is None or value > self.lows[i]):
+            return i
+        return None
+
+
+class FactExtractor:
+
+    def __init__(self, facts, deps, families, index):
+        # facts: name -> function, deps: name -> fields (None: always evaluated)
+        # families: IntervalFamily list, index: FactIndex giving the bit of each fact
+        members = set()
+        self.families = []  # (family, bits of its facts, mask of its facts)
+        for family in families:
+            bits = [index.bit(name) for name in family.names]
+            self.families.append((family, bits, index.mask(family.names)))
+            members.update(family.names)
+
+        self.facts = []  # (bit, function) of every fact not in a family
+        self.always = []  # (bit, function) of the facts evaluated at every step
+        dependents = {}  # tracked field -> (bit, function) of the facts reading it
+        for fact_name, fun in facts.items():
+            if fact_name in members:
+                continue
+            fact = (index.bit(fact_name), fun)
+            fields = deps.get(fact_name)
+            self.facts.append(fact)
+            if fields is None or any(field in VOLATILE_FIELDS for field in fields):
+                self.always.append(fact)
+            else:
+                for field in fields:
+                    dependents.setdefault(field, []).append(fact)
+        self.always_families = [f for f in self.families if f[0].field in VOLATILE_FIELDS]
+        for family, bits, mask in self.families:
+            if family.field not in VOLATILE_FIELDS:
+                dependents.setdefault(family.field, [])
+
+        self.fields = [field for field in STATE_FIELDS if field in dependents]
+        self.dependents = [dependents[field] for field in self.fields]
+        self.field_families = [[f for f in self.families if f[0].field == field] for field in self.fields]
+
+        self.signatures = None  # last signature of each tracked field
+        self.values = 0  # last mask of the facts
+
+    def evaluate(self, facts, values, state, flags):
+        for bit, fun in facts:
+            if fun(state, flags):
+                values |= bit
+            else:
+                values &= ~bit
+        return values
+
+    def lookup(self, families, values, state):
+        for family, bits, mask in families:
+            values &= ~mask
+            i = family.lookup(state[family.field])
+            if i is not None:
+                values |= bits[i]
+        return values
+
+    def sign(self, state):
+        # versions of the tracked fields, None if the state does not have them all
+        versions = state.get("versions")
+        if versions is None:
+            return None
+        try:
+            return [versions[field] for field in self.fields]
+        except KeyError:
+            return None
+
+    def extract(self, state, flags):
+        signatures = self.sign(state)
+        if self.signatures is None or signatures is None:
+            # everything is evaluated the first time, and for the states whose changes cannot be known
+            self.signatures = signatures
+            values = self.evaluate(self.facts, 0, state, flags)
+            self.values = self.lookup(self.families, values, state)
+            return self.values
+
+        values = self.values
+        for bit, fun in self.always:
+            if fun(state, flags):
+                values |= bit
+            else:
+                values &= ~bit
+        for family, bits, mask in self.always_families:
+            values &= ~mask
+            i = family.lookup(state[family.field])
+            if i is not None:
+                values |= bits[i]
+
+        if signatures != self.signatures:
+            for i, old in enumerate(self.signatures):
+                if signatures[i] != old:
+                    values = self.evaluate(self.dependents[i], values, state, flags)
+                    values = self.lookup(self.field_families[i], values, state)
+            self.signatures = signatures
+        self.values = values
+        return values
@@ -0,0 +1,245 @@
+# Compiled version of Pinocchio.judge
+# Every fact is given a bit, so that closures and extensions become bit operations
+
+import numpy as np
+
+from af import AF, IncrementalGrounded
+from epsilon import FactExtractor
+from profiler import section
+
+
+class FactIndex:
+
+    def __init__(self):
+        self.index = {}  # fact name -> bit position
+        self.names = []  # bit position -> fact name
+
+    def bit(self, name):
+        if name not in self.index:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+        return 1 << self.index[name]
+
+    def mask(self, names):
+        mask = 0
+        for name in names:
+            mask |= self.bit(name)
+        return mask
+
+    def decode(self, mask):
+        return [name for i, name in enumerate(self.names) if mask >> i & 1]
+
+
+class ClosureNetwork:
+    # forward chaining over a set of c-norms, given as (premise mask, conclusion mask) rules
+    # each c-norm waits for its premises and fires at most once,
+    # so a closure is linear in the number of c-norms
+
+    def __init__(self, rules):
+        self.conclusions = []  # conclusion mask of each c-norm
+        self.sizes = []  # number of premises of each c-norm
+        self.watchers = {}  # premise bit -> c-norms waiting for it
+        self.unconditional = []  # c-norms without premise
+        for premise, conclusion in rules:
+            rule = len(self.conclusions)
+            self.conclusions.append(conclusion)
+            self.sizes.append(bin(premise).count("1"))
+            if not premise:
+                self.unconditional.append(rule)
+            while premise:
+                bit = premise & -premise
+                premise ^= bit
+                self.watchers.setdefault(bit, []).append(rule)
+
+    @classmethod
+    def fromCNorms(cls, cnorms, index):
+        return cls([(index.mask(cnorm.premise), index.mask(cnorm.conclusion)) for cnorm in cnorms])
+
+    def close(self, mask):
+        missing = self.sizes[:]
+        agenda = self.unconditional[:]
+        for bit, rules in self.watchers.items():
+            if mask & bit:
+                for rule in rules:
+                    missing[rule] -= 1
+                    if missing[rule] == 0:
+                        agenda.append(rule)
+        while agenda:
+            new = self.conclusions[agenda.pop()] & ~mask
+            mask |= new
+            while new:
+                bit = new & -new
+                new ^= bit
+                for rule in self.watchers.get(bit, ()):
+                    missing[rule] -= 1
+                    if missing[rule] == 0:
+                        agenda.append(rule)
+        return mask
+
+
+class CompiledNorm:
+
+    def __init__(self, rnorm, bit):
+        self.rnorm = rnorm
+        self.name = str(rnorm)
+        self.bit = bit  # the norm is itself an argument of its AF
+        self.semantics = rnorm.semantics
+        self.acceptance = rnorm.acceptance
+        self.premise = 0  # mask of the premises checked by comply
+        self.stakeholders = []  # (closure slot, arguments mask) of each stakeholder
+        self.arguments = []  # (argument bit, attackers mask) of the merged AF
+        self.evaluator = None  # incremental grounded labelling of the merged AF
+
+
+class CompiledJudgement(FactIndex):
+
+    def __init__(self, norms, stakeholders, facts, deps={}, families=[]):
+        super().__init__()
+        self.base = 0  # facts that always hold (the regulative norms)
+        self.norms = []
+        self.slots = {}  # c-norm rules -> closure slot, shared by identical (norm, stakeholder) pairs
+
+        for rnorm in norms:
+            self.base |= self.bit(str(rnorm))
+        self.mask(facts)  # brute facts, in registration order
+        self.facts = list(facts)  # bit i of the packed masks of evaluateBatch is the i-th brute fact
+        self.tables = {}  # override -> packed mask -> violation of each norm
+        self.extractor = FactExtractor(facts, deps, families, self)
+        for rnorm in norms:
+            self.norms.append(self.compileNorm(rnorm, stakeholders))
+
+        # all the closures of a judgement run in one network:
+        # each slot works on its own copy of the facts, shifted by slot * width
+        self.width = len(self.names)
+        self.full = (1 << self.width) - 1
+        self.replicate = 0
+        shifted = []
+        for rules, slot in self.slots.items():
+            shift = slot * self.width
+            self.replicate |= 1 << shift
+            shifted.extend((premise << shift, conclusion << shift) for premise, conclusion in rules)
+        self.network = ClosureNetwork(shifted)
+
+    def compileNorm(self, rnorm, stakeholders):
+        normName = str(rnorm)
+        norm = CompiledNorm(rnorm, self.bit(normName))
+        norm.premise = self.mask(rnorm.premise)
+
+        attackers = {}  # argument bit -> attackers mask
+        for stakeholder in stakeholders:
+            if normName not in stakeholder.c_norms or normName not in stakeholder.afs:
+                raise ValueError(f"Norm '{normName}' does not exist in stakeholder '{stakeholder.name}'. (In compile)")
+            rules = tuple((self.mask(cnorm.premise), self.mask(cnorm.conclusion))
+                          for cnorm in stakeholder.c_norms[normName])
+            slot = self.slots.setdefault(rules, len(self.slots))
+            af = stakeholder.afs[normName]
+            norm.stakeholders.append((slot, self.mask(af.arguments)))
+            for arg in af.arguments:
+                attackers.setdefault(self.bit(arg), 0)
+            for attacker, attacked in af.getAttacks():
+                attacked_bit = self.bit(attacked)
+                attackers[attacked_bit] = attackers.get(attacked_bit, 0) | self.bit(attacker)
+        norm.arguments = tuple(attackers.items())
+        norm.evaluator = IncrementalGrounded(norm.arguments)
+        return norm
+
+    def epsilon(self, state, flags):
+        return self.base | self.extractor.extract(state, flags)
+
+    def activeAF(self, norm, active):
+        # explicit AF of the active arguments, for the semantics other than grounded
+        af = AF()
+        for bit, attackers in norm.arguments:
+            if active & bit:
+                af.addArgument(self.names[bit.bit_length() - 1])
+        for bit, attackers in norm.arguments:
+            if active & bit:
+                for attacker in self.decode(attackers & active):
+                    af.addAttack(attacker, self.names[bit.bit_length() - 1])
+        return af
+
+    def comply(self, norm, mask):
+        # mirrors RegulativeNorm.comply
+        premisesInFacts = mask & norm.premise == norm.premise
+        if norm.rnorm.isProhibition():
+            return not premisesInFacts
+        if norm.rnorm.isObligation():
+            return premisesInFacts
+        return None
+
+    def pack(self, facts):
+        # facts: brute fact name -> boolean array, the missing facts do not hold
+        # returns the packed masks of evaluateBatch
+        if len(self.facts) > 63:
+            raise ValueError(f"Too many brute facts to pack: {len(self.facts)}, at most 63 are supported.")
+        packed = None
+        for name, values in facts.items():
+            if name not in self.facts:
+                raise ValueError(f"Unknown brute fact: {name}. (In pack)")
+            column = np.asarray(values, dtype=np.int64) << self.facts.index(name)
+            packed = column if packed is None else packed | column
+        return packed
+
+    def unpack(self, packed):
+        mask = 0
+        for i, name in enumerate(self.facts):
+            if packed >> i & 1:
+                mask |= self.bit(name)
+        return mask
+
+    def evaluateBatch(self, packed, override={}):
+        # packed: array of brute fact masks, bit i is the i-th brute fact
+        # returns the violation of each norm, with shape packed.shape + (norms,)
+        # each distinct mask is evaluated once, and kept for the next batches
+        packed = np.asarray(packed)
+        values, inverse = np.unique(packed, return_inverse=True)
+        table = self.tables.setdefault(frozenset(override.items()), {})
+        rows = np.empty((len(values), len(self.norms)))
+        for i, value in enumerate(values.tolist()):
+            row = table.get(value)
+            if row is None:
+                violations = self.evaluate(self.unpack(value), override)
+                row = table[value] = [violations[norm.name] for norm in self.norms]
+            rows[i] = row
+        return rows[inverse.reshape(-1)].reshape(packed.shape + (len(self.norms),))
+
+    def closures(self, mask):
+        # closure of the facts for every slot, in a single pass
+        closed = self.network.close((mask | self.base) * self.replicate)
+        return [closed >> (slot * self.width) & self.full for slot in range(len(self.slots))]
+
+    def evaluate(self, mask, override={}, debug=False, profiler=None):
+        # profiler: times the closure, shared by the norms, then each norm
+        with section(profiler, "closure"):
+            closures = self.closures(mask)
+        violations = {}
+        for norm in self.norms:
+            with section(profiler, f"norm {norm.name}"):
+                violations[norm.name] = 0
+                all_facts = 0
+                active = 0
+                for slot, arguments in norm.stakeholders:
+                    fact_closure = closures[slot]
+                    all_facts |= fact_closure
+                    active |= fact_closure & arguments
+                if norm.semantics == "grounded":
+                    # only the components downstream of a change of activation are relabelled
+                    extension = norm.evaluator.update(active)
+                    normActive = bool(extension & norm.bit)
+                else:
+                    af = self.activeAF(norm, active)
+                    normActive = af.isAccepted(norm.name, norm.semantics, norm.acceptance)
+                    extension = self.mask(af.computeExtension(norm.semantics)) if debug else 0
+
+                if norm.name in override:
+                    normActive = override[norm.name]
+
+                didViolation = False
+                if normActive and not self.comply(norm, all_facts):
+                    violations[norm.name] = -norm.rnorm.weight
+                    didViolation = True
+                if debug:
+                    print("Inst.", norm.name, ":", self.decode(all_facts))
+                    print("Violates", norm.name, ":", didViolation, '| Extension:', self.decode(extension))
+
+        return violations
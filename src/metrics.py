@@ -0,0 +1,162 @@
+# Online metrics of a run, updated at each step in constant time and memory, and queryable while it runs
+# Environment.run keeps one RunMetrics in env.metrics
+
+import array
+from collections import deque
+
+
+class Window:
+    # mean, min and max of the last values, in O(1) per value (amortized for min and max)
+
+    def __init__(self, size):
+        if size <= 0:
+            raise ValueError("Window size must be positive")
+        self.size = size
+        self.count = 0
+        # running sums of the last size + 1 values, as a ring: the mean is a difference of two sums,
+        # the same floats as a moving average computed from the cumulative sums of the whole run
+        self.cumsums = [0] * (size + 1)
+        self.mins = deque()  # (position, value), increasing values
+        self.maxs = deque()  # (position, value), decreasing values
+
+    def push(self, value):
+        t = self.count
+        self.cumsums[(t + 1) % (self.size + 1)] = self.cumsums[t % (self.size + 1)] + value
+        self.count = t + 1
+        mins, maxs = self.mins, self.maxs
+        while mins and mins[-1][1] >= value:
+            mins.pop()
+        mins.append((t, value))
+        if mins[0][0] <= t - self.size:
+            mins.popleft()
+        while maxs and maxs[-1][1] <= value:
+            maxs.pop()
+        maxs.append((t, value))
+        if maxs[0][0] <= t - self.size:
+            maxs.popleft()
+
+    def full(self):
+        return self.count >= self.size
+
+    def mean(self):
+        n = min(self.count, self.size)
+        if n == 0:
+            return None
+        t = self.count
+        return (self.cumsums[t % (self.size + 1)] - self.cumsums[(t - n) % (self.size + 1)]) / n
+
+    def min(self):
+        return self.mins[0][1] if self.mins else None
+
+    def max(self):
+        return self.maxs[0][1] if self.maxs else None
+
+
+class EWMA:
+
+    def __init__(self, alpha):
+        if not 0 < alpha <= 1:
+            raise ValueError("EWMA alpha must be in (0, 1]")
+        self.alpha = alpha
+        self.value = None
+
+    def push(self, value):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+
+
+class RunMetrics:
+
+    def __init__(self, window, episodes=100, alpha=None, curves=True):
+        # window: steps of the moving windows, episodes: episodes of the windows of episode totals
+        # alpha: of the EWMAs, 2 / (window + 1) by default, curves: keep the moving average of each full window
+        if window <= 0:
+            raise ValueError("Window size must be positive")
+        self.window = window
+        self.episodes = episodes
+        self.alpha = 2 / (window + 1) if alpha is None else alpha
+        self.curves = curves
+        self.steps = 0
+        self.episode_count = 0
+        self.signals = []  # names, in the order of the first step
+        self.windows = {}  # signal -> Window of the steps
+        self.ewmas = {}  # signal -> EWMA of the steps
+        self.totals = {}  # signal -> sum over the run
+        self.episode = {}  # signal -> sum over the current episode
+        self.episode_windows = {}  # signal -> Window of the episode totals
+        self.averages = {}  # signal -> moving average of each full window, the evolution of the run
+        self.norms = []
+        self.norm_windows = {}  # norm -> Window of its violations (1 when violated)
+        self.norm_counts = {}  # norm -> steps where it was violated
+
+    def addSignal(self, name):
+        self.signals.append(name)
+        self.windows[name] = Window(self.window)
+        self.ewmas[name] = EWMA(self.alpha)
+        self.totals[name] = 0
+        self.episode[name] = 0
+        self.episode_windows[name] = Window(self.episodes)
+        self.averages[name] = array.array("d")
+
+    def addNorm(self, name):
+        self.norms.append(name)
+        self.norm_windows[name] = Window(self.window)
+        self.norm_counts[name] = 0
+
+    def update(self, signals, violations=None):
+        # signals: signal -> value of the step, violations: norm -> violation of the step (0 when complied)
+        if not self.signals:
+            for name in signals:
+                self.addSignal(name)
+        self.steps += 1
+        for name in self.signals:
+            value = signals.get(name, 0)
+            window = self.windows[name]
+            window.push(value)
+            self.ewmas[name].push(value)
+            self.totals[name] += value
+            self.episode[name] += value
+            if self.curves and window.full():
+                self.averages[name].append(window.mean())
+        if violations:
+            for name, violation in violations.items():
+                if name not in self.norm_windows:
+                    self.addNorm(name)
+                violated = 1 if violation else 0
+                self.norm_windows[name].push(violated)
+                self.norm_counts[name] += violated
+
+    def endEpisode(self):
+        # returns the totals of the episode that ended
+        totals = self.episode
+        for name, value in totals.items():
+            self.episode_windows[name].push(value)
+        self.episode = {name: 0 for name in self.signals}
+        self.episode_count += 1
+        return totals
+
+    def get(self, name):
+        window = self.windows[name]
+        return {"mean": window.mean(), "min": window.min(), "max": window.max(), "ewma": self.ewmas[name].value,
+                "total": self.totals[name], "episode_mean": self.episode_windows[name].mean()}
+
+    def getMeans(self):
+        return {name: self.windows[name].mean() for name in self.signals}
+
+    def getViolationRates(self):
+        # share of the steps of the window where each norm was violated
+        return {name: self.norm_windows[name].mean() for name in self.norms}
+
+    def getCurve(self, name):
+        # moving average of the signal over each full window of the run
+        if name not in self.averages:
+            return []
+        return self.averages[name].tolist()
+
+    def summary(self):
+        return {"steps": self.steps, "episodes": self.episode_count,
+                "signals": {name: self.get(name) for name in self.signals},
+                "violation_rates": self.getViolationRates(),
+                "violations": dict(self.norm_counts)}
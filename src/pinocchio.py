@@ -1,8 +1,15 @@
 from qagent import QAgent
-import copy as cp
 import random as rd
+from collections import OrderedDict
 from af import *
-from dqn_agent import DQNAgent
+from judgement import CompiledJudgement, ClosureNetwork, FactIndex
+from epsilon import FactExtractor, IntervalFamily, STATE_FIELDS
+from replay import ReplayBuffer
+from profiler import section
+try:
+    from dqn_agent import DQNAgent
+except ImportError:  # the torch DQN agent is optional, the tabular agents do not need it
+    DQNAgent = None
 
 
 class ConstitutiveNorm:
@@ -44,6 +51,25 @@ class RegulativeNorm:
         self.premise = prem  # 'a'
 
         self.weight = 1.0
+        self.semantics = "grounded"  # semantics used to decide if the norm is active
+        self.acceptance = "skeptical"  # or "credulous", for semantics with several extensions
+        self.listeners = []  # called whenever the semantics or the weight are edited
+
+    def changed(self):
+        for listener in self.listeners:
+            listener()
+
+    def setSemantics(self, semantics, acceptance="skeptical"):
+        if semantics not in SEMANTICS:
+            raise ValueError(f"Unknown semantics: {semantics}. Known semantics: {SEMANTICS}")
+        self.semantics = semantics
+        self.acceptance = acceptance
+        self.changed()
+
+    def setWeight(self, weight):
+        # the cached judgements hold the weighted violations, edit the weight here rather than directly
+        self.weight = weight
+        self.changed()
 
     def isProhibition(self):
         return self.type == "F"
@@ -77,17 +103,27 @@ class Stakeholder:
     def __init__(self, name="no_name"):
         self.name = name
         self.c_norms = {}  # cnorms for each regulative norm
-        self.afs = {}  # afs for each regulative norm
+        self.afs = {}  # afs for each regulative norm, edited through the setters (or call changed() after)
+        self.listeners = []  # called whenever the c-norms or the afs are edited
+        self.index = FactIndex()  # fact ids used by the closure networks
+        self.networks = {}  # closure network for each regulative norm, built on demand
+
+    def changed(self):
+        self.networks = {}
+        for listener in self.listeners:
+            listener()
 
     def addNorm(self, rnorm):
         normName = str(rnorm)
         self.c_norms[normName] = []
         self.afs[normName] = AF()
+        self.changed()
 
     def addConstitutiveNorm(self, rnorm, cnorm):
         normName = str(rnorm)
         if normName in self.c_norms:
             self.c_norms[normName].append(cnorm)
+            self.changed()
         else:
             raise ValueError(f"Norm '{normName}' does not exist in stakeholder '{self.name}'. (In addConstitutiveNorm)")
 
@@ -95,14 +131,24 @@ class Stakeholder:
         normName = str(rnorm)
         if normName in self.c_norms:
             self.c_norms[normName].extend(cnorms)
+            self.changed()
         else:
             raise ValueError(f"Norm '{normName}' does not exist in stakeholder '{self.name}'. (In setConstitutiveNorms)")
 
+    def setAF(self, rnorm, af):
+        normName = str(rnorm)
+        if normName in self.afs:
+            self.afs[normName] = af
+            self.changed()
+        else:
+            raise ValueError(f"Norm '{normName}' does not exist in stakeholder '{self.name}'. (In setAF)")
+
     def setArguments(self, rnorm, arguments):
         normName = str(rnorm)
         if normName in self.afs:
             for arg in arguments:
                 self.afs[normName].addArgument(arg)
+            self.changed()
         else:
             raise ValueError(f"Norm '{normName}' does not exist in stakeholder '{self.name}'. (In setArguments)")
 
@@ -111,33 +157,28 @@ class Stakeholder:
         if normName in self.afs:
             for attack in attacks:
                 self.afs[normName].addAttack(attack[0], attack[1])
+            self.changed()
         else:
             raise ValueError(f"Norm '{normName}' does not exist in stakeholder '{self.name}'. (In setAttacks)")
         
-    def closure(self, rnorm, facts):
+    def getClosureNetwork(self, rnorm):
         normName = str(rnorm)
-        factSize = len(facts)
-        stop = False
-        while not stop:
-            facts = self.closureStep(normName, facts)
-            if len(facts) == factSize:
-                stop = True
-            factSize = len(facts)
-        return facts
-
-    def closureStep(self, rnorm, facts):
-        normName = str(rnorm)
-        new_facts = cp.deepcopy(facts)
-        for cnorm in self.c_norms[normName]:
-            premiseInFacts = True
-            for premise in cnorm.premise:
-                if premise not in facts:
-                    premiseInFacts = False
-                    break
-            if premiseInFacts:
-                new_facts.extend(cnorm.conclusion)
-        return list(set(new_facts))
-    
+        if normName not in self.networks:
+            self.networks[normName] = ClosureNetwork.fromCNorms(self.c_norms[normName], self.index)
+        return self.networks[normName]
+
+    def closure(self, rnorm, facts):
+        network = self.getClosureNetwork(rnorm)
+        # facts unknown to the c-norms are passed through untouched
+        mask = 0
+        others = []
+        for fact in facts:
+            if fact in self.index.index:
+                mask |= self.index.bit(fact)
+            elif fact not in others:
+                others.append(fact)
+        return self.index.decode(network.close(mask)) + others
+
     def getActiveArguments(self, rnorm, facts):
         normName = str(rnorm)
         if normName in self.afs:
@@ -155,30 +196,164 @@ class Pinocchio:
     def __init__(self, name="no_name"):
         self.name = name
         # self.agent = QAgent(name)
-        self.agent = DQNAgent(name, 101, 8)  # 8 combinations of (direction, speed)
+        if DQNAgent is not None:
+            self.agent = DQNAgent(name, 101, 8)  # 8 combinations of (direction, speed)
+        else:
+            self.agent = QAgent(name)  # replaced by the presets, see loadNormativeAgent
         self.stakeholders = []
         self.norms = []
         self.facts = {}
+        self.fact_deps = {}  # state fields read by each fact, None if undeclared
+        self.fact_families = []  # IntervalFamily of the facts added with addIntervalFacts
+        self.extractor = None  # FactExtractor of the uncompiled epsilon, built on demand
         self.override = {}
+        self.compiled = None  # frozen evaluator built by compile()
+        self.recompile = False  # compile() was called: judge rebuilds the evaluator dropped by invalidate()
+        self.cache = None  # LRU cache of the judgements, see enableCache
+        self.cache_size = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.lastViolations = {}  # per-norm breakdown of the last judgement
+        self.replay = None  # ReplayBuffer of the transitions, see enableReplay
+        self.replay_batch = 0  # transitions replayed after each step
+        self.profiler = None  # Profiler timing the judgements, set by Environment.enableProfiling
+
+    def enableCache(self, size=1024):
+        # opt-in: memoize the judgement on (brute facts, overrides)
+        if size <= 0:
+            raise ValueError("Cache size must be positive")
+        self.cache = OrderedDict()
+        self.cache_size = size
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def disableCache(self):
+        self.cache = None
+        self.cache_size = 0
+
+    def getCacheStats(self):
+        size = len(self.cache) if self.cache is not None else 0
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "size": size, "max_size": self.cache_size}
+
+    def enableReplay(self, capacity=10000, batch=32, sampling="uniform", **kwargs):
+        # opt-in: keep the transitions and replay a batch of them after each learning step
+        # kwargs: alpha, beta and min_priority of the prioritized sampling
+        if batch <= 0:
+            raise ValueError("Replay batch must be positive")
+        self.replay = ReplayBuffer(capacity, sampling, **kwargs)
+        self.replay_batch = batch
+
+    def disableReplay(self):
+        self.replay = None
+        self.replay_batch = 0
+
+    def invalidate(self):
+        # the norms, stakeholders or facts changed: drop everything derived from them
+        self.compiled = None
+        self.extractor = None
+        if self.cache is not None:
+            self.cache.clear()
+
+    def compile(self):
+        # freeze the norms, stakeholders and facts into a bitmask evaluator
+        # must be called again (or is reset) whenever one of them changes
+        self.invalidate()
+        self.recompile = True
+        self.compiled = CompiledJudgement(self.norms, self.stakeholders, self.facts, self.fact_deps, self.fact_families)
+        return self.compiled
+
+    def printJudgementHeader(self, flags, facts):
+        print("JUDGES", self.name, id(self.agent))
+        print("Inv.:", self.getInventory())
+        print("Last action:", self.getLastAction())
+        print("Flags:", flags)
+        print("Brute:", facts)
 
     def judge(self, state, flags, debug=False):
+        prof = self.profiler
+        if self.compiled is None and self.recompile:
+            self.compile()
+        with section(prof, "epsilon"):
+            if self.compiled is None:
+                brute = self.epsilon(state, flags)
+                key = frozenset(brute)
+            else:
+                brute = self.compiled.epsilon(state, flags)
+                key = brute
+
+        if self.cache is not None and not debug:
+            key = (key, frozenset(self.override.items()) if self.override else None)
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+                if prof is not None:
+                    prof.count("cache_hits")
+                self.lastViolations = cached[1]
+                return cached[0]
+            self.cache_misses += 1
+
+        if self.compiled is None:
+            violations = self.judgeAF(state, flags, debug, brute)
+        else:
+            if debug:
+                self.printJudgementHeader(flags, self.compiled.decode(brute))
+            violations = self.compiled.evaluate(brute, self.override, debug, prof)
+        total = sum(violations.values())  # sum of violated norms' weights
+
+        if self.cache is not None and not debug:
+            self.cache[key] = (total, violations)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        self.lastViolations = violations
+        return total
+
+    def getLastViolations(self):
+        return self.lastViolations
+
+    def getNormNames(self):
+        return [str(rnorm) for rnorm in self.norms]
+
+    def packFacts(self, facts):
+        # facts: brute fact name -> boolean array, packed into the masks taken by judgeBatch
+        if self.compiled is None:
+            self.compile()
+        return self.compiled.pack(facts)
+
+    def judgeBatch(self, packed, override=None):
+        # judge of many states at once, given as packed brute fact masks (bit i: i-th fact added)
+        # returns the total violation of each state and the violation of each norm (see getNormNames)
+        if self.compiled is None:
+            self.compile()
+        if override is None:
+            override = self.override
+        violations = self.compiled.evaluateBatch(packed, override)
+        return violations.sum(axis=-1), violations
+
+    def judgeAF(self, state, flags, debug=False, brute=None):
+        # reference judgement, building the AF of each norm from scratch
+        # returns the violation of each norm
         # add all rnorms to the facts
         facts = []
         for rnorm in self.norms:
             facts.append(str(rnorm))
         # apply the epsilon function to get the facts
-        facts.extend(self.epsilon(state, flags))
+        if brute is None:
+            brute = self.epsilon(state, flags)
+        facts.extend(brute)
+        # closure of each (norm, stakeholder) pair, computed once and shared with the debug output
+        prof = self.profiler
+        with section(prof, "closure"):
+            closures = {}
+            for rnorm in self.norms:
+                closures[str(rnorm)] = [stakeholder.closure(rnorm, facts) for stakeholder in self.stakeholders]
         if debug:
-            print("JUDGES", self.name, id(self.agent))
-            print("Inv.:", self.getInventory())
-            print("Last action:", self.getLastAction())
-            print("Flags:", flags)
-            print("Brute:", facts)
+            self.printJudgementHeader(flags, facts)
             inst = {}
             for rnorm in self.norms:
                 inst[str(rnorm)] = []
-                for stakeholder in self.stakeholders:
-                    inst[str(rnorm)].extend(stakeholder.closure(rnorm, facts))
+                for fact_closure in closures[str(rnorm)]:
+                    inst[str(rnorm)].extend(fact_closure)
                 inst[str(rnorm)] = list(set(inst[str(rnorm)]))
                 print("Inst.", str(rnorm), ":", inst[str(rnorm)])
             # for each norm
@@ -186,56 +361,80 @@ class Pinocchio:
         # then judges
         violations = {}
         for rnorm in self.norms:
-
-            violations[str(rnorm)] = 0
-            af = AF()
-            all_facts = []
-            all_attacks = []
-            all_active = []
-            for stakeholder in self.stakeholders:
-                fact_closure = stakeholder.closure(rnorm, facts)
-                all_facts.extend(fact_closure)
-                active_args = stakeholder.getActiveArguments(rnorm, fact_closure)
-                for arg in active_args:
-                    af.addArgument(arg)
-                    if arg not in all_active:
-                        all_active.append(arg)
-                for attack in stakeholder.afs[str(rnorm)].getAttacks():
-                    if attack not in all_attacks:
-                        all_attacks.append(attack)
-            for attack in all_attacks:
-                if attack[0] in all_active and attack[1] in all_active:
-                    af.addAttack(attack)
+            with section(prof, f"norm {rnorm}"):
+                violations[str(rnorm)] = 0
+                af = AF()
+                all_facts = []
+                all_attacks = []
+                all_active = []
+                for stakeholder, fact_closure in zip(self.stakeholders, closures[str(rnorm)]):
+                    all_facts.extend(fact_closure)
+                    active_args = stakeholder.getActiveArguments(rnorm, fact_closure)
+                    for arg in active_args:
+                        af.addArgument(arg)
+                        if arg not in all_active:
+                            all_active.append(arg)
+                    for attack in stakeholder.afs[str(rnorm)].getAttacks():
+                        if attack not in all_attacks:
+                            all_attacks.append(attack)
+                for attack in all_attacks:
+                    if attack[0] in all_active and attack[1] in all_active:
+                        af.addAttack(attack)
             
-            # compute the extension
-            extension = af.computeExtension("grounded")
-            didViolation = False
-            # print(all_facts, extension, "Comply:", rnorm.comply(all_facts))
-            normActive = str(rnorm) in extension
-            if str(rnorm) in self.override:
-                normActive = self.override[str(rnorm)]
-
-            if normActive and not rnorm.comply(all_facts):
-                violations[str(rnorm)] = -rnorm.weight
-                didViolation = True
-            if debug:
-                print("Violates", str(rnorm), ":", didViolation, '| Extension:', extension)
-                pass
-
-        return sum(violations.values())  # return the sum of violated norms' weights
+                # compute the extension
+                didViolation = False
+                if rnorm.semantics == "grounded":
+                    extension = af.computeExtension("grounded")
+                    normActive = str(rnorm) in extension
+                else:
+                    normActive = af.isAccepted(str(rnorm), rnorm.semantics, rnorm.acceptance)
+                    extension = af.computeExtension(rnorm.semantics) if debug else []
+                # print(all_facts, extension, "Comply:", rnorm.comply(all_facts))
+                if str(rnorm) in self.override:
+                    normActive = self.override[str(rnorm)]
+
+                if normActive and not rnorm.comply(all_facts):
+                    violations[str(rnorm)] = -rnorm.weight
+                    didViolation = True
+                if debug:
+                    print("Violates", str(rnorm), ":", didViolation, '| Extension:', extension)
+                    pass
+
+        return violations
     
-    def addFact(self, fact_name, fun):
-        if fact_name not in self.facts:
-            self.facts[fact_name] = fun
-        else:
+    def addFact(self, fact_name, fun, deps=None):
+        # deps: state fields read by fun (see STATE_FIELDS), the fact is then
+        # only re-evaluated when one of them changes. None: evaluated every time
+        if fact_name in self.facts:
             raise ValueError(f"Fact '{fact_name}' already exists in Pinocchio '{self.name}'.")
-    
+        if deps is not None:
+            for field in deps:
+                if field not in STATE_FIELDS:
+                    raise ValueError(f"Unknown state field '{field}' for fact '{fact_name}'. Known fields: {STATE_FIELDS}")
+            deps = tuple(deps)
+        self.facts[fact_name] = fun
+        self.fact_deps[fact_name] = deps
+        self.invalidate()
+
+    def addIntervalFacts(self, field, intervals):
+        # family of facts low < state[field] <= high, given as (fact_name, low, high)
+        # evaluated together with a single interval lookup
+        family = IntervalFamily(field, intervals)
+        for fact_name, low, high in intervals:
+            self.addFact(fact_name, lambda state, flags, low=low, high=high:
+                         (low is None or state[field] > low) and (high is None or state[field] <= high), [field])
+        self.fact_families.append(family)
+
+    def getExtractor(self):
+        if self.extractor is None:
+            index = FactIndex()
+            index.mask(self.facts)  # bits in registration order
+            self.extractor = (FactExtractor(self.facts, self.fact_deps, self.fact_families, index), index)
+        return self.extractor
+
     def epsilon(self, state, flags):
-        facts = []
-        for fact_item in self.facts:
-            if self.facts[fact_item](state, flags):
-                facts.append(fact_item)
-        return facts
+        extractor, index = self.getExtractor()
+        return index.decode(extractor.extract(state, flags))
     
     def overrideJudgement(self, norm_name, value):
         self.override[norm_name] = value
@@ -248,8 +447,16 @@ class Pinocchio:
 
     def addStakeholder(self, stakeholder):
         self.stakeholders.append(stakeholder)
+        stakeholder.listeners.append(self.invalidate)
+        self.invalidate()
+
+    def isTabular(self):
+        # tabular agents are keyed by the full state and handle their own exploration
+        return isinstance(self.agent, QAgent) and not (DQNAgent is not None and isinstance(self.agent, DQNAgent))
 
     def getAction(self, state, epsilon=0):
+        if self.isTabular():
+            return self.agent.getAction(state)
         return self.agent.getAction(state, epsilon)
     
     def selectBestAction(self, state):
@@ -259,24 +466,56 @@ class Pinocchio:
         self.agent.updateQValue(q, state, action, reward, next_state, optimal_action)
 
     def updateQFunctions(self, state, action, reward, violation, next_state, done):
-        self.agent.updateQFunctions(state, action, reward, violation, next_state, done)
+        if self.isTabular():
+            self.agent.updateQFunctions(state, action, {"R": reward, "V": violation}, next_state, done=done)
+        else:
+            self.agent.updateQFunctions(state, action, reward, violation, next_state, done)
+        if self.replay is not None and self.agent.learning:
+            self.replay.add(state, action, reward, violation, next_state, done)
+            self.replayTransitions()
+
+    def replayTransitions(self):
+        # updates the agent on a batch of past transitions
+        indices, weights = self.replay.sample(self.replay_batch)
+        if not self.isTabular():
+            for i in indices:
+                self.agent.updateQFunctions(*self.replay.get(i))
+            return
+        agent = self.agent
+        alpha, epsilon, trace_decay = agent.alpha, agent.epsilon, agent.trace_decay
+        agent.trace_decay = 0  # the replayed transitions are not consecutive
+        prioritized = self.replay.sampling == "prioritized"
+        errors = []
+        for i, weight in zip(indices.tolist(), weights.tolist()):
+            state, action, reward, violation, next_state, done = self.replay.get(i)
+            signals = {"R": reward, "V": violation}
+            if prioritized:
+                errors.append(abs(agent.getTDErrors(state, action, signals, next_state)).sum())
+            agent.alpha = alpha * weight  # importance-sampling correction, 1 with the uniform sampling
+            agent.updateQFunctions(state, action, signals, next_state, done=done)
+        # the replays are not steps: the exploration schedule is left as it was
+        agent.alpha, agent.epsilon, agent.trace_decay = alpha, epsilon, trace_decay
+        if prioritized:
+            self.replay.updatePriorities(indices, errors)
 
     def setActions(self, actions):
         self.agent.setActions(actions)
 
-    def loadOptimalAgent(self, steps):
-        self.agent = QAgent(self.name)
+    def loadOptimalAgent(self, steps, storage="dict"):
+        self.agent = QAgent(self.name, storage)
         self.agent.addQFunction("R")
         self.agent.initDecay(steps)
 
-    def loadNormativeAgent(self, steps):
-        self.agent = QAgent(self.name)
+    def loadNormativeAgent(self, steps, storage="dict"):
+        self.agent = QAgent(self.name, storage)
         self.agent.addQFunction("V")
         self.agent.addQFunction("R")
         self.agent.initDecay(steps)
         self.agent.selection_method = "lex"
 
     def loadDQNAgent(self, steps, agent_type='std'):
+        if DQNAgent is None:
+            raise ImportError("The DQN agent needs the dqn_agent module and torch.")
         self.agent = DQNAgent(self.name, 101, 8, agent_type=agent_type)  # 8 combinations of (direction, speed)
 
     def setSteps(self, steps):
@@ -285,6 +524,8 @@ class Pinocchio:
     def addNorm(self, norm):
         # add regulative norm
         self.norms.append(norm)
+        norm.listeners.append(self.invalidate)
+        self.invalidate()
 
     def getInventory(self):
         return self.agent.getInventory()
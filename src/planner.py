@@ -0,0 +1,213 @@
+# Exact lexicographic planning on the known model of a loaded preset, as a reference for the learned agents
+# the reachable states (position, inventory, objects) are enumerated by running the environment's own action
+# method and judgement from each of them, then solved by backward value iteration over the iteration count
+# the iteration count is exact (the facts read it), so the horizon is the timeout of the preset
+
+import time
+
+import numpy as np
+
+SIGNALS = ["R", "V"]
+
+
+class Planner:
+
+    def __init__(self, env, preferences=["V", "R"], gamma=1, tolerance=0):
+        # env: Environment with a loaded single-agent preset
+        # preferences: signals in lexicographic order, tolerance: kept actions below the best one at each level
+        # but the last, gamma: 1 gives the expected totals of an episode
+        if len(env.agents) != 1:
+            raise ValueError(f"The planner supports a single agent, the preset has {len(env.agents)}.")
+        for q in preferences:
+            if q not in SIGNALS:
+                raise ValueError(f"Unknown signal: {q}. Known signals: {SIGNALS}")
+        self.env = env
+        self.agent = env.agents[0]
+        self.preferences = list(preferences)
+        self.gamma = gamma
+        self.tolerance = tolerance
+        self.actions = env.getActions()
+        self.horizon = env.timeout
+        self.stochasticity = env.stochasticity if env.doAction == env.doAction_1 else 0  # only doAction_1 slips
+
+        self.objects = {}  # objects of the preset at the start of an episode
+        self.states = []  # (cell, inventory, objects) of each reachable state
+        self.state_index = {}
+
+        # model, one entry per state, action and outcome of the action
+        self.next = None  # (states, actions, outcomes) next state
+        self.prob = None  # (states, actions, outcomes) probability of the outcome
+        self.end = None  # (states, actions, outcomes) the episode ended
+        self.rewards = None  # (states, actions, outcomes) R signal
+        self.violations = None  # (horizon, states, actions, outcomes) V signal, judged at each iteration count
+
+        self.values = {}  # signal -> (horizon + 1, states) value of the policy
+        self.policy = None  # (horizon, states) action index
+        self.best = None  # (horizon, states, actions) actions kept by the lexicographic selection
+        self.times = {}
+
+    def getCore(self):
+        env = self.env
+        pos = env.pos[self.agent.name]
+        # the objects are listed in a fixed order, a reset may append them to env.objects in another one
+        objects = tuple(name for name in self.objects if name in env.objects)
+        return (pos[0] + pos[1] * env.width, tuple(sorted(self.agent.getInventory())), objects)
+
+    def setCore(self, core):
+        env = self.env
+        cell, inventory, objects = core
+        env.pos[self.agent.name] = [cell % env.width, cell // env.width]  # new list, the action methods move it
+        self.agent.resetInventory()
+        self.agent.addItemsToInventory(list(inventory))
+        env.objects = {name: self.objects[name] for name in objects}
+        env.touch("pos", "objects", "inventory")
+
+    def addState(self, core):
+        i = self.state_index.get(core)
+        if i is None:
+            i = self.state_index[core] = len(self.states)
+            self.states.append(core)
+        return i
+
+    def getOutcomes(self, a):
+        # (probability, executed action) of the intended action a
+        if self.stochasticity > 0:
+            others = [b for b in range(len(self.actions)) if b != a]
+            return [(1 - self.stochasticity, a)] + [(self.stochasticity / len(others), b) for b in others]
+        return [(1, a)]
+
+    def build(self):
+        env = self.env
+        start = time.perf_counter()
+        stochasticity, last_action = env.stochasticity, self.agent.getLastAction()
+        env.loadPreset(env.loadedPreset, reset_agent=False)
+        env.iterations = 0
+        env.stochasticity = 0  # the outcomes of doAction_1 are enumerated instead
+        self.objects = dict(sorted(env.objects.items(), key=lambda item: item[0]))
+        self.states, self.state_index = [], {}
+        self.addState(self.getCore())
+
+        # deterministic moves: (state, executed action) -> (next state, R, flags, end)
+        moves = {}
+        i = 0
+        while i < len(self.states):
+            for b, action in enumerate(self.actions):
+                self.setCore(self.states[i])
+                self.agent.setLastAction(action)
+                signals, flags, global_flags = env.doAction(self.agent, action)
+                flags = env.mergeFlags(flags, global_flags)
+                end = "end" in global_flags
+                moves[i, b] = (self.addState(self.getCore()), signals["R"], flags, end)
+            i += 1
+        self.times["explore"] = time.perf_counter() - start
+
+        outcomes = max(len(self.getOutcomes(a)) for a in range(len(self.actions)))
+        shape = (len(self.states), len(self.actions), outcomes)
+        self.next = np.zeros(shape, dtype=np.int64)
+        self.prob = np.zeros(shape)
+        self.end = np.zeros(shape, dtype=bool)
+        self.rewards = np.zeros(shape)
+        self.violations = np.zeros((self.horizon,) + shape)
+
+        # judgement of each outcome at each iteration count, each distinct brute fact mask is evaluated once
+        start = time.perf_counter()
+        if self.agent.compiled is None:
+            self.agent.compile()
+        compiled = self.agent.compiled
+        judged = {}
+        for (i, a), _ in sorted(moves.items()):
+            for k, (p, b) in enumerate(self.getOutcomes(a)):
+                j, reward, flags, end = moves[i, b]
+                self.next[i, a, k] = j
+                self.prob[i, a, k] = p
+                self.end[i, a, k] = end
+                self.rewards[i, a, k] = reward
+                self.setCore(self.states[j])
+                self.agent.setLastAction(self.actions[a])  # the facts read the intended action
+                for t in range(self.horizon):
+                    env.iterations = t
+                    mask = compiled.epsilon(env.getStateDict(1), flags)
+                    violation = judged.get(mask)
+                    if violation is None:
+                        violation = judged[mask] = sum(compiled.evaluate(mask, self.agent.override).values())
+                    self.violations[t, i, a, k] = violation
+        self.times["judge"] = time.perf_counter() - start
+
+        env.stochasticity = stochasticity
+        env.loadPreset(env.loadedPreset, reset_agent=False)
+        env.iterations = 0
+        self.agent.setLastAction(last_action)
+        return self
+
+    def solve(self):
+        # one vectorized sweep per iteration count, from the last one
+        start = time.perf_counter()
+        n_states, n_actions = len(self.states), len(self.actions)
+        self.values = {q: np.zeros((self.horizon + 1, n_states)) for q in self.preferences}
+        self.policy = np.zeros((self.horizon, n_states), dtype=np.int64)
+        self.best = np.zeros((self.horizon, n_states, n_actions), dtype=bool)
+        states = np.arange(n_states)
+        for t in reversed(range(self.horizon)):
+            continuing = ~self.end if t + 1 < self.horizon else np.zeros(self.end.shape, dtype=bool)
+            qvalues = {}
+            mask = np.ones((n_states, n_actions), dtype=bool)
+            for level, q in enumerate(self.preferences):
+                signal = self.rewards if q == "R" else self.violations[t]
+                future = self.gamma * np.where(continuing, self.values[q][t + 1][self.next], 0)
+                qvalues[q] = (self.prob * (signal + future)).sum(axis=2)
+                best = np.where(mask, qvalues[q], -np.inf).max(axis=1)
+                tolerance = self.tolerance if level < len(self.preferences) - 1 else 0
+                mask &= qvalues[q] >= best[:, None] - tolerance
+            self.best[t] = mask
+            self.policy[t] = mask.argmax(axis=1)  # first kept action, as QAgent.getAction
+            for q in self.preferences:
+                self.values[q][t] = qvalues[q][states, self.policy[t]]
+        self.times["solve"] = time.perf_counter() - start
+        return self
+
+    def plan(self):
+        return self.build().solve()
+
+    def getValues(self, t=0, core=None):
+        # expected signals of the policy from a state, the start of an episode by default
+        i = 0 if core is None else self.state_index[core]
+        return {q: float(self.values[q][t, i]) for q in self.preferences}
+
+    def getBestActions(self):
+        # actions kept by the lexicographic selection in the current state of the environment, None if unknown
+        i = self.state_index.get(self.getCore())
+        if i is None or self.env.iterations >= self.horizon:
+            return None
+        return [action for action, kept in zip(self.actions, self.best[self.env.iterations, i]) if kept]
+
+    def getAction(self):
+        i = self.state_index.get(self.getCore())
+        if i is None or self.env.iterations >= self.horizon:
+            return None
+        return self.actions[self.policy[self.env.iterations, i]]
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import sys
+    from environment import Environment
+
+    parser = argparse.ArgumentParser(description="Exact lexicographic values of a preset.")
+    parser.add_argument("--presets", nargs="+", default=["mini_taxi", "taxi", "adam"])
+    parser.add_argument("--preferences", nargs="+", default=["V", "R"], choices=SIGNALS)
+    parser.add_argument("--gamma", type=float, default=1)
+    args = parser.parse_args()
+
+    for preset in args.presets:
+        # presets that cannot be planned here are skipped: a missing optional agent, or several agents
+        env = Environment()
+        try:
+            env.loadPreset(preset)
+            planner = Planner(env, args.preferences, args.gamma)
+        except (ImportError, ValueError) as error:
+            print(f"Skipping {preset}: {error}", file=sys.stderr)
+            continue
+        planner.plan()
+        times = {name: round(seconds, 2) for name, seconds in planner.times.items()}
+        print(f"{preset}: {len(planner.states)} states, values per episode {planner.getValues()}, times {times}")
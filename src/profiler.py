@@ -0,0 +1,85 @@
+# Opt-in timers of the phases of a run, see Environment.enableProfiling
+# the instrumented code wraps its phases in `with section(profiler, phase):`, which does nothing without a profiler
+# a section opened inside another one is one of its children: the report gives the total time of each section,
+# and the time spent in the section itself, out of its children
+
+import contextlib
+import time
+
+NO_SECTION = contextlib.nullcontext()
+
+
+def section(profiler, phase):
+    return NO_SECTION if profiler is None else profiler.section(phase)
+
+
+class Profiler:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.times = {}  # path of the section (tuple of the phases) -> seconds
+        self.counts = {}  # path -> number of timings, or of counts
+        self.stack = []  # paths of the open sections
+        self.starts = []  # clock at the start of each open section
+        self.phase = None  # phase of the section being entered
+
+    def section(self, phase):
+        self.phase = phase
+        return self
+
+    def __enter__(self):
+        path = (self.stack[-1] if self.stack else ()) + (self.phase,)
+        self.stack.append(path)
+        self.starts.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.starts.pop()
+        path = self.stack.pop()
+        self.times[path] = self.times.get(path, 0) + elapsed
+        self.counts[path] = self.counts.get(path, 0) + 1
+        return False
+
+    def count(self, phase, n=1):
+        # counter without timing in the current section, e.g. cache hits
+        path = (self.stack[-1] if self.stack else ()) + (phase,)
+        self.counts[path] = self.counts.get(path, 0) + n
+
+    def summary(self, parent=()):
+        # phase -> total seconds, calls, mean microseconds per call, seconds out of the children and the children,
+        # slowest phases first
+        paths = [path for path in self.counts if len(path) == len(parent) + 1 and path[:len(parent)] == parent]
+        paths.sort(key=lambda path: -self.times.get(path, 0))
+        summary = {}
+        for path in paths:
+            seconds = self.times.get(path)
+            children = self.summary(path)
+            stats = {"time": seconds, "calls": self.counts[path],
+                     "mean_us": None if seconds is None else seconds / self.counts[path] * 1e6}
+            if seconds is not None:
+                stats["self"] = seconds - sum(child["time"] or 0 for child in children.values())
+            if children:
+                stats["children"] = children
+            summary[path[-1]] = stats
+        return summary
+
+    def report(self, summary=None, total=None, depth=0):
+        # prints a summary, the current one by default, with the share of total seconds of each phase
+        # the shares of the phases of a level add up to at most the share of their parent
+        if summary is None:
+            summary = self.summary()
+        if depth == 0:
+            print("============== PROFILE ===============")
+        indent = "  " * (depth + 1)
+        for phase, stats in summary.items():
+            if stats["time"] is None:
+                print(f"{indent}{phase}: {stats['calls']} calls")
+                continue
+            share = f" ({stats['time'] / total * 100:.1f}%)" if total else ""
+            own = f", self {stats['self']:.3f}s" if "children" in stats else ""
+            print(f"{indent}{phase}: {stats['time']:.3f}s{share}{own}, {stats['calls']} calls, "
+                  f"{stats['mean_us']:.1f} us/call")
+            if "children" in stats:
+                self.report(stats["children"], total, depth + 1)
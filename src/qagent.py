@@ -1,16 +1,29 @@
-import copy as cp
 import random as rd
 
+import numpy as np
+
+from qtable import QTable
+
+STORAGES = ["dict", "array"]
+UPDATE_METHODS = ["sequential", "batched"]
+EPSILON_SCHEDULES = ["update", "step"]
+
 
 class QAgent:
 
-    def __init__(self, name="no_name"):
+    def __init__(self, name="no_name", storage="dict"):
         self.name = name
 
+        if storage not in STORAGES:
+            raise ValueError(f"Unknown storage: {storage}. Known storages: {STORAGES}")
+        self.storage = storage  # "dict": state -> action -> value, "array": QTable
+        self.table = None  # QTable of the array storage, built once the actions are known
+
         self.Q = {}  # Q-functions
         self.preferences = []  # [a, b, c] <=> Q_a > Q_b > Q_c
 
         self.actions = []
+        self.mask_indices = {}  # action mask -> indices of its actions
         self.inventory = []
 
         self.decay_method = "linear"
@@ -19,15 +32,24 @@ class QAgent:
         self.epsilon_decay = 0
         self.alpha = 0.05  #0.05
         self.gamma = 0.99
+        self.rounding = 2  # decimals of the Q-values, None to keep them exact
+
+        self.update_method = "sequential"  # "batched": all the Q-functions updated together, one TD error each
+        self.epsilon_schedule = "update"  # "update": epsilon decays at each Q-value update, "step": once per step
+        self.trace_decay = 0  # lambda of Watkins' Q(lambda), no eligibility traces when 0
+        self.trace_threshold = 0.01  # traces below are dropped
+        self.traces = {}  # (state, action) -> eligibility, only the non-zero ones
 
         self.isRandom = False
         self.optimal = False
         self.learning = True
 
         self.selection_method = "lex"
+        self.vectorized = False  # selection over the stacked Q-functions of the array storage
 
         self.lastAction = None
         self.lastSignal = None
+        self.explored = False  # the last action was not a greedy one
 
     def getLastAction(self):
         return self.lastAction
@@ -42,8 +64,17 @@ class QAgent:
         self.lastSignal = signal
 
     def setActions(self, actions):
+        if self.table is not None and list(actions) != self.table.actions:
+            raise ValueError("The actions cannot change once the array storage is used.")
         self.actions = actions
 
+    def getTable(self):
+        if self.table is None:
+            self.table = QTable(self.actions)
+            for q in self.Q:
+                self.table.addQFunction(q)
+        return self.table
+
     def getInventory(self):
         return self.inventory
     
@@ -59,6 +90,8 @@ class QAgent:
         self.inventory = []
         
     def getQValues(self, qfunction, state):
+        if self.storage == "array":
+            return self.getTable().toDict(qfunction, state)
         return self.Q[qfunction].get(state, {})
     
     def initDecay(self, steps):
@@ -77,39 +110,86 @@ class QAgent:
 
     def addQFunction(self, name):
         if name not in self.Q:
-            self.Q[name] = {}
+            self.Q[name] = {}  # stays empty with the array storage
             self.preferences.append(name)
+            if self.table is not None:
+                self.table.addQFunction(name)
         else:
             raise ValueError(f"Q-function '{name}' already exists.")
 
-    def getBestActions(self, qfunction, state, actions=None, tolerance=0, fixed=False):
-        if actions is None:
-            actions = cp.deepcopy(self.actions)
-        qvalues = self.getQValues(qfunction, state)
+    def getRow(self, qfunction, state):
+        # values of the Q-function in the state, in the order of the actions, None if never updated
+        if self.storage == "array":
+            return self.getTable().get(qfunction, state)
+        qvalues = self.Q[qfunction].get(state)
         if not qvalues:
             return None
-        max_value = max([qvalues[action] for action in actions if action in qvalues])
+        return list(qvalues.values())  # initialized in the order of the actions by updateQValue
+
+    def getMaskIndices(self, mask):
+        # indices of the actions of an action mask (bit i: i-th action), cached since masks are few
+        indices = self.mask_indices.get(mask)
+        if indices is None:
+            indices = self.mask_indices[mask] = tuple(i for i in range(mask.bit_length()) if mask >> i & 1)
+        return indices
+
+    def getActionMask(self, actions=None):
+        if actions is None:
+            return (1 << len(self.actions)) - 1
+        mask = 0
+        for i, action in enumerate(self.actions):
+            if action in actions:
+                mask |= 1 << i
+        return mask
+
+    def getMaskActions(self, mask):
+        return list(map(self.actions.__getitem__, self.getMaskIndices(mask)))
+
+    def bestMask(self, values, mask, tolerance=0, fixed=False):
+        # narrows an action mask to its best actions
+        indices = self.getMaskIndices(mask)
+        max_value = max(map(values.__getitem__, indices))
         # apply tolerance
         if fixed:
             max_value = max_value - tolerance
         else:
-            max_value = max_value - (tolerance / 100) * abs(max_value - min(qvalues.values()))
-        return [action for action, value in qvalues.items() if value >= max_value and action in actions]
-    
+            max_value = max_value - (tolerance / 100) * abs(max_value - min(values))
+        best = 0
+        for i in indices:
+            if values[i] >= max_value:
+                best |= 1 << i
+        return best
+
+    def thresholdMask(self, values, mask, threshold=0):
+        # narrows an action mask to its actions above the threshold, or to its best actions if there are none
+        indices = self.getMaskIndices(mask)
+        possible = 0
+        for i in indices:
+            if values[i] >= threshold:
+                possible |= 1 << i
+        if possible:
+            return possible
+        max_value = max(map(values.__getitem__, indices))
+        for i in indices:
+            if values[i] == max_value:
+                possible |= 1 << i
+        return possible
+
+    def getBestActions(self, qfunction, state, actions=None, tolerance=0, fixed=False):
+        values = self.getRow(qfunction, state)
+        if values is None:
+            return None
+        return self.getMaskActions(self.bestMask(values, self.getActionMask(actions), tolerance, fixed))
+
     def getActionsAboveThreshold(self, qfunction, state, actions=None, threshold=0):
-        if actions is None:
-            actions = cp.deepcopy(self.actions)
-        qvalues = self.getQValues(qfunction, state)
-        if not qvalues:
+        values = self.getRow(qfunction, state)
+        if values is None:
             return None
-        possible = [action for action, value in qvalues.items() if value >= threshold and action in actions]
-        if len(possible) > 0:
-            return possible
-        # if no actions above threshold, return the best actions
-        max_value = max([qvalues[action] for action in actions if action in qvalues])
-        return [action for action, value in qvalues.items() if value == max_value and action in actions]
+        return self.getMaskActions(self.thresholdMask(values, self.getActionMask(actions), threshold))
 
     def selectBestAction(self, state):
+        if self.vectorized and self.storage == "array":
+            return self.selectBestActions([state])[0]
         if self.selection_method == "lex":
             return self.lexicographic(state)
         if self.selection_method == "tlex":
@@ -117,47 +197,88 @@ class QAgent:
         if self.selection_method == "dlex":
             return self.deltaLexicographic(state, 0.1, True)
 
+    # the selections narrow a mask of the actions, one preference after the other
+    # a Q-function never updated in the state gives no actions (None), and the next one starts from all of them
+
     def lexicographic(self, state):
-        actions = cp.deepcopy(self.actions)
+        all_actions = (1 << len(self.actions)) - 1
+        mask = all_actions
         for q in self.preferences:
-            # print(actions, end="->")
-            actions = self.getBestActions(q, state, actions)
-        # print(actions)
-        return actions
+            values = self.getRow(q, state)
+            mask = None if values is None else self.bestMask(values, all_actions if mask is None else mask)
+        return None if mask is None else self.getMaskActions(mask)
 
     def thresholdLexicographic(self, state):
         # TODO: doesnt seem to work for now - fix later
-        actions = cp.deepcopy(self.actions)
+        all_actions = (1 << len(self.actions)) - 1
+        mask = all_actions
         for q in self.preferences:
-            # print(actions, end="->")
-            actions = self.getActionsAboveThreshold(q, state, actions, -0.5)
-        # print(actions)
-        return actions
+            values = self.getRow(q, state)
+            mask = None if values is None else self.thresholdMask(values, all_actions if mask is None else mask, -0.5)
+        return None if mask is None else self.getMaskActions(mask)
 
     def deltaLexicographic(self, state, tolerance=10, fixed=False):
         # tolerance in percent
-        actions = cp.deepcopy(self.actions)
+        all_actions = (1 << len(self.actions)) - 1
+        mask = all_actions
         t = tolerance
         for i, q in enumerate(self.preferences):
-            # print(actions, end="->")
             if i == len(self.preferences) - 1:
                 # last preference, no tolerance
                 t = 0
-            actions = self.getBestActions(q, state, actions, t, fixed)
-        # print(actions)
-        return actions
+            values = self.getRow(q, state)
+            mask = None if values is None else self.bestMask(values, all_actions if mask is None else mask, t, fixed)
+        return None if mask is None else self.getMaskActions(mask)
+
+    def getSelectionParameters(self):
+        # parameters of QTable.select giving the selections of selectBestAction
+        if self.selection_method == "lex":
+            return {"method": "lex"}
+        if self.selection_method == "tlex":
+            return {"method": "tlex", "threshold": -0.5}
+        if self.selection_method == "dlex":
+            return {"method": "dlex", "tolerance": 0.1, "fixed": True}
+        raise ValueError(f"Unknown selection method: {self.selection_method}")
+
+    def selectBestActions(self, states):
+        # selectBestAction for a batch of states, in one pass per preference with the array storage
+        if self.storage != "array":
+            return [self.selectBestAction(state) for state in states]
+        table = self.getTable()
+        masks, none = table.select(table.rows(states), self.preferences, **self.getSelectionParameters())
+        return [None if empty else [self.actions[i] for i in mask.nonzero()[0]] for mask, empty in zip(masks, none)]
 
     def getAction(self, state):
+        self.explored = True
         if self.isRandom or (not self.optimal and (rd.random() < self.epsilon)):
             return rd.choice(self.actions)
         else:
             best_actions = self.selectBestAction(state)
             if best_actions:
+                self.explored = False
                 return best_actions[0]
             else:
                 return rd.choice(self.actions)
 
+    def decayEpsilon(self):
+        if self.decay_method == "linear":
+            self.epsilon -= self.epsilon_decay
+        elif self.decay_method == "exponential":
+            self.epsilon *= self.epsilon_decay
+        self.epsilon = max(self.min_epsilon, self.epsilon)
+
+    def roundValue(self, value):
+        if self.rounding is None:
+            return value
+        value = round(value, self.rounding)
+        if value == -0.0:
+            value = 0.0
+        return value
+
     def updateQValue(self, q, state, action, reward, next_state, optimal_action=None):
+        if self.storage == "array":
+            self.updateQValueArray(q, state, action, reward, next_state, optimal_action)
+            return
         # Hash the state if it's a list (to use as a dict key)
         # Flatten state and next_state if they are lists of lists, then hash as tuple
         qvalues = self.getQValues(q, state)
@@ -169,33 +290,144 @@ class QAgent:
         if optimal_action is not None:
             max_next_q = self.getQValues(q, next_state).get(optimal_action, 0)
         qvalues[action] += self.alpha * (reward + self.gamma * max_next_q - qvalues[action])
-        qvalues[action] = round(qvalues[action], 2)
-        if qvalues[action] == -0.0:
-            qvalues[action] = 0.0
+        qvalues[action] = self.roundValue(qvalues[action])
         self.Q[q][state] = qvalues
 
-        if self.decay_method == "linear":
-            self.epsilon -= self.epsilon_decay
-        elif self.decay_method == "exponential":
-            self.epsilon *= self.epsilon_decay
-        self.epsilon = max(self.min_epsilon, self.epsilon)
+        if self.epsilon_schedule == "update":
+            self.decayEpsilon()
+
+    def updateQValueArray(self, q, state, action, reward, next_state, optimal_action=None):
+        # same update as updateQValue, on the row of the state
+        table = self.getTable()
+        next_values = table.get(q, next_state)
+        max_next_q = 0
+        if next_values is not None:
+            if optimal_action is not None:
+                max_next_q = next_values[table.action_index[optimal_action]]
+            else:
+                max_next_q = max(next_values)
+        row = table.row(state)
+        values = table.values[q]
+        table.visited[q][row] = True
+        a = table.action_index[action]
+        value = values.item(row, a)
+        value += self.alpha * (reward + self.gamma * max_next_q - value)
+        values[row, a] = self.roundValue(value)
+
+        if self.epsilon_schedule == "update":
+            self.decayEpsilon()
 
-    def updateQFunctions(self, state, action, signals, next_state, optimal_action=None):
+    def updateQFunctions(self, state, action, signals, next_state, optimal_action=None, done=False):
         # print(signals, action)
         if not self.learning:
             return
         for q in self.preferences:
             if q not in signals:
                 raise ValueError(f"Signal '{q}' not found in signals. Available signals: {list(signals.keys())}")
-            self.updateQValue(q, state, action, signals[q], next_state, optimal_action)
+        if self.update_method not in UPDATE_METHODS:
+            raise ValueError(f"Unknown update method: {self.update_method}. Known methods: {UPDATE_METHODS}")
+        if self.epsilon_schedule not in EPSILON_SCHEDULES:
+            raise ValueError(f"Unknown epsilon schedule: {self.epsilon_schedule}. Known schedules: {EPSILON_SCHEDULES}")
+
+        if self.update_method == "sequential" and not self.trace_decay:
+            for q in self.preferences:
+                self.updateQValue(q, state, action, signals[q], next_state, optimal_action)
+        else:
+            self.updateBatch(state, action, signals, next_state, optimal_action, done)
+            if self.epsilon_schedule == "update":
+                for _ in self.preferences:
+                    self.decayEpsilon()
+        if self.epsilon_schedule == "step":
+            self.decayEpsilon()
+
+    def getOrder(self):
+        # positions of the preferences in the stacked arrays, a slice when they are stacked in that order
+        table = self.getTable()
+        if table.qfunctions == self.preferences:
+            return slice(None)
+        return [table.qfunctions.index(q) for q in self.preferences]
+
+    def getTDErrors(self, state, action, signals, next_state, optimal_action=None):
+        # TD error of every Q-function of the preferences for the transition, computed before any update
+        rewards = np.array([signals[q] for q in self.preferences], dtype=float)
+        if self.storage == "array":
+            table = self.getTable()
+            order = self.getOrder()
+            max_next = 0
+            next_row = table.index.get(next_state)
+            if next_row is not None:
+                next_values = table.stacked[next_row, order]
+                if optimal_action is not None:
+                    next_values = next_values[:, table.action_index[optimal_action]]
+                else:
+                    next_values = next_values.max(axis=1)
+                max_next = np.where(table.stacked_visited[next_row, order], next_values, 0)
+            row = table.row(state)  # may grow the table
+            values = table.stacked[row, order, table.action_index[action]]
+            return rewards + self.gamma * max_next - values
+        errors = np.zeros(len(self.preferences))
+        for k, q in enumerate(self.preferences):
+            next_qvalues = self.getQValues(q, next_state)
+            if optimal_action is not None:
+                max_next_q = next_qvalues.get(optimal_action, 0)
+            else:
+                max_next_q = max(next_qvalues.values(), default=0)
+            errors[k] = rewards[k] + self.gamma * max_next_q - self.getQValues(q, state).get(action, 0.0)
+        return errors
+
+    def updateBatch(self, state, action, signals, next_state, optimal_action=None, done=False):
+        # one TD error per Q-function, applied to the state-action pair, or to every eligible pair with traces
+        errors = self.alpha * self.getTDErrors(state, action, signals, next_state, optimal_action)
+        if self.trace_decay:
+            if self.explored:
+                # the action was not greedy: the return no longer follows the greedy policy of the earlier pairs
+                self.traces = {}
+            self.traces[(state, action)] = 1.0  # replacing traces
+            pairs = list(self.traces.items())
+        else:
+            pairs = [((state, action), 1.0)]
+
+        if self.storage == "array":
+            table = self.getTable()
+            order = self.getOrder()
+            rows = [table.row(s) for (s, a), e in pairs]
+            columns = [table.action_index[a] for (s, a), e in pairs]
+            if len(pairs) == 1:
+                values = table.stacked[rows[0], :, columns[0]]  # view of the Q-functions of the pair
+                values[order] += errors
+                if self.rounding is not None:
+                    values[:] = [self.roundValue(value) for value in values.tolist()]
+            else:
+                values = table.stacked[rows, :, columns]  # (pairs, Q-functions)
+                values[:, order] += np.array([e for _, e in pairs])[:, None] * errors
+                if self.rounding is not None:
+                    # rounded as round() does, np.round differs on the decimal ties
+                    values = [[self.roundValue(value) for value in pair] for pair in values.tolist()]
+                table.stacked[rows, :, columns] = values
+            table.stacked_visited[table.row(state), order] = True
+        else:
+            errors = errors.tolist()
+            for k, q in enumerate(self.preferences):
+                for (s, a), e in pairs:
+                    qvalues = self.getQValues(q, s)
+                    if a not in qvalues:
+                        for other in self.actions:
+                            qvalues[other] = 0.0
+                    qvalues[a] = self.roundValue(qvalues[a] + e * errors[k])
+                    self.Q[q][s] = qvalues
+
+        if self.trace_decay:
+            if done:
+                self.traces = {}
+            else:
+                decay = self.gamma * self.trace_decay
+                self.traces = {pair: e * decay for pair, e in pairs if e * decay >= self.trace_threshold}
 
     def printQFunctions(self, state):
         rounding = 2
         print(f"Q-functions for agent {id(self)}:")
         for q in self.preferences:
-            qvalues = cp.deepcopy(self.getQValues(q, state))
-            for qvalue in qvalues:
-                qvalues[qvalue] = round(qvalues[qvalue], rounding)
+            qvalues = {action: round(value, rounding) for action, value in self.getQValues(q, state).items()}
             print(f"Q_{q}: {qvalues}")
         print("Optimal action:", self.selectBestAction(state))
 
@@ -0,0 +1,109 @@
+# Array storage of tabular Q-functions, used by QAgent when storage="array"
+# states are interned to row indices, the Q-functions are stacked in one (states, Q-functions, actions) array
+# growing by chunks
+
+import numpy as np
+
+SELECTION_METHODS = ["lex", "tlex", "dlex"]
+
+
+class QTable:
+
+    def __init__(self, actions, chunk=4096):
+        self.actions = list(actions)
+        self.action_index = {action: i for i, action in enumerate(self.actions)}
+        self.chunk = chunk
+        self.index = {}  # state -> row
+        self.capacity = 0
+        self.qfunctions = []  # Q-function -> position in the stacked arrays
+        self.stacked = np.zeros((0, 0, len(self.actions)))  # (capacity, Q-functions, actions)
+        self.stacked_visited = np.zeros((0, 0), dtype=bool)  # rows updated at least once, per Q-function
+        self.values = {}  # Q-function -> (capacity, actions) view of the stacked values
+        self.visited = {}  # Q-function -> (capacity,) view of the stacked visited rows
+
+    def addQFunction(self, name):
+        self.qfunctions.append(name)
+        self.resize(self.capacity)
+
+    def resize(self, capacity):
+        stacked = np.zeros((capacity, len(self.qfunctions), len(self.actions)))
+        stacked[:self.capacity, :self.stacked.shape[1]] = self.stacked
+        visited = np.zeros((capacity, len(self.qfunctions)), dtype=bool)
+        visited[:self.capacity, :self.stacked_visited.shape[1]] = self.stacked_visited
+        self.capacity = capacity
+        self.stacked = stacked
+        self.stacked_visited = visited
+        for k, name in enumerate(self.qfunctions):
+            self.values[name] = stacked[:, k]
+            self.visited[name] = visited[:, k]
+
+    def grow(self):
+        self.resize(self.capacity + self.chunk)
+
+    def row(self, state):
+        # row of the state, interned on first use
+        row = self.index.get(state)
+        if row is None:
+            row = len(self.index)
+            if row >= self.capacity:
+                self.grow()
+            self.index[state] = row
+        return row
+
+    def rows(self, states):
+        # rows of a batch of states, -1 for the states never seen
+        return np.array([self.index.get(state, -1) for state in states], dtype=np.int64)
+
+    def get(self, qfunction, state):
+        # values of the actions in the state, None if the Q-function was never updated there
+        # a single row is small: it is read as a list, the arrays are for the batched operations
+        row = self.index.get(state)
+        if row is None or not self.visited[qfunction][row]:
+            return None
+        return self.values[qfunction][row].tolist()
+
+    def toDict(self, qfunction, state):
+        values = self.get(qfunction, state)
+        if values is None:
+            return {}
+        return {action: float(value) for action, value in zip(self.actions, values)}
+
+    def size(self):
+        return len(self.index)
+
+    def select(self, rows, preferences, method="lex", tolerance=0, fixed=False, threshold=-0.5):
+        # lexicographic selection for a batch of rows, with the semantics of QAgent.selectBestAction
+        # lex: best actions of each Q-function, dlex: with a tolerance except for the last one (relative
+        # in percent, or fixed), tlex: actions above the threshold, the best ones if there are none
+        # returns the mask of the selected actions, shape (rows, actions), and the rows without selection
+        if method not in SELECTION_METHODS:
+            raise ValueError(f"Unknown selection method: {method}. Known methods: {SELECTION_METHODS}")
+        rows = np.asarray(rows, dtype=np.int64)
+        order = [self.qfunctions.index(q) for q in preferences]
+        known = rows >= 0
+        if len(self.stacked) == 0:  # nothing stored yet, no state has a selection
+            return np.ones((len(rows), len(self.actions)), dtype=bool), np.ones(len(rows), dtype=bool)
+        gathered = np.where(known, rows, 0)  # the unknown states read row 0, masked as never visited
+        values = self.stacked[gathered][:, order]  # (rows, preferences, actions)
+        visited = self.stacked_visited[gathered][:, order] & known[:, None]
+
+        mask = np.ones((len(rows), len(self.actions)), dtype=bool)
+        none = np.zeros(len(rows), dtype=bool)  # the last Q-function was never updated in the state
+        for k in range(len(order)):
+            current = values[:, k]
+            start = mask | none[:, None]  # a Q-function without values restarts from all the actions
+            max_value = np.where(start, current, -np.inf).max(axis=1)
+            if method == "tlex":
+                narrowed = start & (current >= threshold)
+                empty = ~narrowed.any(axis=1)
+                narrowed[empty] = (start & (current == max_value[:, None]))[empty]
+            else:
+                t = tolerance if method == "dlex" and k < len(order) - 1 else 0
+                if fixed:
+                    max_value = max_value - t
+                else:
+                    max_value = max_value - (t / 100) * np.abs(max_value - current.min(axis=1))
+                narrowed = start & (current >= max_value[:, None])
+            mask = np.where(visited[:, k, None], narrowed, start)
+            none = ~visited[:, k]
+        return mask, none
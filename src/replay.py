@@ -0,0 +1,91 @@
+# Experience replay: the transitions of an agent in preallocated ring buffers, sampled uniformly or by priority
+# states and actions are interned to integer indices, the columns are NumPy arrays of fixed capacity
+
+import numpy as np
+
+SAMPLINGS = ["uniform", "prioritized"]
+
+
+class ReplayBuffer:
+
+    def __init__(self, capacity=10000, sampling="uniform", alpha=0.6, beta=0.4, min_priority=1e-3):
+        if capacity <= 0:
+            raise ValueError("Replay capacity must be positive")
+        if sampling not in SAMPLINGS:
+            raise ValueError(f"Unknown sampling: {sampling}. Known samplings: {SAMPLINGS}")
+        self.capacity = capacity
+        self.sampling = sampling
+        self.alpha = alpha  # how much the priorities count, 0 is uniform
+        self.beta = beta  # correction of the importance-sampling weights, 1 is full correction
+        self.min_priority = min_priority  # transitions with no TD error can still be sampled
+
+        # interned states and actions, index -> object
+        # they grow with the distinct states and actions seen, as the Q-tables do, not with the transitions
+        self.states = []
+        self.state_index = {}
+        self.actions = []
+        self.action_index = {}
+
+        self.state = np.zeros(capacity, dtype=np.int64)
+        self.action = np.zeros(capacity, dtype=np.int64)
+        self.reward = np.zeros(capacity)
+        self.violation = np.zeros(capacity)
+        self.next_state = np.zeros(capacity, dtype=np.int64)
+        self.done = np.zeros(capacity, dtype=bool)
+        self.priority = np.zeros(capacity)
+        self.max_priority = 1.0  # given to the new transitions, so that they are sampled at least once
+
+        self.position = 0  # next slot to write
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def intern(self, obj, objects, index):
+        # states of the DQN agent are dicts, keyed by their items
+        key = tuple(obj.items()) if isinstance(obj, dict) else obj
+        i = index.get(key)
+        if i is None:
+            i = index[key] = len(objects)
+            objects.append(obj)
+        return i
+
+    def add(self, state, action, reward, violation, next_state, done):
+        i = self.position
+        self.state[i] = self.intern(state, self.states, self.state_index)
+        self.action[i] = self.intern(action, self.actions, self.action_index)
+        self.reward[i] = reward
+        self.violation[i] = violation
+        self.next_state[i] = self.intern(next_state, self.states, self.state_index)
+        self.done[i] = done
+        self.priority[i] = self.max_priority
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, batch):
+        # returns the slots of the sampled transitions and their importance-sampling weights
+        if self.size == 0:
+            raise ValueError("Cannot sample from an empty replay buffer")
+        if self.sampling == "uniform":
+            return np.random.randint(self.size, size=batch), np.ones(batch)
+        probabilities = self.priority[:self.size] ** self.alpha
+        probabilities /= probabilities.sum()
+        indices = np.random.choice(self.size, size=batch, p=probabilities)
+        weights = (self.size * probabilities[indices]) ** -self.beta
+        return indices, weights / weights.max()
+
+    def get(self, i):
+        # transition of a slot, as given to add
+        return (self.states[self.state[i]], self.actions[self.action[i]], self.reward[i].item(),
+                self.violation[i].item(), self.states[self.next_state[i]], bool(self.done[i]))
+
+    def updatePriorities(self, indices, errors):
+        # errors: absolute TD errors of the sampled transitions
+        priorities = np.maximum(np.abs(errors), self.min_priority)
+        self.priority[indices] = priorities
+        self.max_priority = max(self.max_priority, priorities.max())
+
+    def clear(self):
+        self.position = 0
+        self.size = 0
+        self.max_priority = 1.0
@@ -0,0 +1,125 @@
+# Streaming log of a run: the signals of each step are appended to one binary file per signal
+# only the totals are kept in memory, the steps are read back from the files on demand
+# the moving averages are computed online by RunMetrics and saved with the log when it is closed
+
+import array
+import json
+import os
+
+import numpy as np
+
+DTYPE = "<f8"  # every column is stored as little-endian float64
+
+
+class RunLog:
+
+    def __init__(self, path, window, chunk=4096):
+        # path: directory of the run, created if needed
+        # window: size of the moving averages saved with the log
+        self.path = path
+        self.window = window
+        self.chunk = chunk  # steps buffered in memory before being written
+        self.columns = []  # signal names, in the order of the first step
+        self.files = {}  # signal -> open file, while the run is logged
+        self.buffers = {}  # signal -> values of the steps not written yet
+        self.buffered = 0
+        self.steps = 0
+        self.totals = {}  # signal -> sum over the run
+        self.averages = {}  # signal -> moving average of each full window, given to close
+        self.closed = False
+        os.makedirs(path, exist_ok=True)
+
+    def __len__(self):
+        return self.steps
+
+    def addColumn(self, name):
+        self.columns.append(name)
+        self.files[name] = open(os.path.join(self.path, f"{name}.f8"), "wb")
+        self.buffers[name] = np.zeros(self.chunk, dtype=DTYPE)
+        self.totals[name] = 0
+
+    def append(self, log):
+        # log: signal -> value of one step, as appended to the logs list of Environment.run
+        if self.closed:
+            raise ValueError(f"Run log '{self.path}' is closed.")
+        if not self.columns:
+            for name in log:
+                self.addColumn(name)
+        i = self.buffered
+        for name in self.columns:
+            value = log.get(name, 0)
+            self.buffers[name][i] = value
+            self.totals[name] += value
+        self.buffered = i + 1
+        self.steps += 1
+        if self.buffered == self.chunk:
+            self.flush()
+
+    def flush(self):
+        for name in self.columns:
+            self.files[name].write(self.buffers[name][:self.buffered].tobytes())
+        self.buffered = 0
+
+    def close(self, averages={}):
+        # writes the remaining steps, the moving averages (signal -> values) and the metadata
+        # the log can then be reloaded with load
+        if self.closed:
+            return
+        self.flush()
+        for file in self.files.values():
+            file.close()
+        self.averages = {name: array.array("d", averages.get(name, [])) for name in self.columns}
+        for name, values in self.averages.items():
+            with open(os.path.join(self.path, f"{name}.avg.f8"), "wb") as file:
+                file.write(np.asarray(values, dtype=DTYPE).tobytes())
+        self.files = {}
+        self.buffers = {}
+        self.closed = True
+        with open(os.path.join(self.path, "meta.json"), "w") as file:
+            json.dump({"columns": self.columns, "dtype": DTYPE, "steps": self.steps, "window": self.window,
+                       "totals": self.totals}, file, default=float)
+
+    def movingAverage(self, name):
+        # moving average of a signal saved by close
+        if self.window <= 0:
+            raise ValueError("Window size must be positive")
+        if name not in self.averages:
+            return []
+        return self.averages[name].tolist()
+
+    def getColumn(self, name):
+        # values of a signal at each step, mapped from its file
+        if not self.closed:
+            self.flush()
+            self.files[name].flush()
+        if self.steps == 0:
+            return np.zeros(0, dtype=DTYPE)
+        return np.memmap(os.path.join(self.path, f"{name}.f8"), dtype=DTYPE, mode="r", shape=(self.steps,))
+
+    def __iter__(self):
+        # the steps as dicts, like the logs list of Environment.run
+        columns = [self.getColumn(name) for name in self.columns]
+        for start in range(0, self.steps, self.chunk):
+            values = [column[start:start + self.chunk].tolist() for column in columns]
+            for row in zip(*values):
+                yield dict(zip(self.columns, row))
+
+    @classmethod
+    def load(cls, path):
+        # run log written by a previous process, read only
+        with open(os.path.join(path, "meta.json"), "r") as file:
+            meta = json.load(file)
+        log = cls.__new__(cls)
+        log.path = path
+        log.window = meta["window"]
+        log.chunk = 4096
+        log.columns = meta["columns"]
+        log.files = {}
+        log.buffers = {}
+        log.buffered = 0
+        log.steps = meta["steps"]
+        log.totals = meta["totals"]
+        log.averages = {name: array.array("d", np.fromfile(os.path.join(path, f"{name}.avg.f8"), dtype=DTYPE))
+                        for name in log.columns}
+        log.closed = True
+        return log
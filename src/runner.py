@@ -0,0 +1,189 @@
+# Runs a grid of experiments (preset, seed, agent type, hyper-parameters) on a pool of processes
+# each job executes the loadPreset / run pipeline of main.py and returns the historic of its environment
+
+from environment import *
+import random as rd
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+AGENT_TYPES = ["default", "dqn", "optimal", "normative"]
+
+# phases of a job, as in main.py: the first one trains the agent, the others reuse it
+DEFAULT_PHASES = [
+    {"title": "Training"},
+    {"title": "Testing", "steps": 1000, "optimal": True, "learning": False},
+]
+
+
+def makeJobs(presets, seeds, agent_types=["default"], params={}, phases=DEFAULT_PHASES, steps=None, log_dir=None,
+             profile=False):
+    # params: hyper-parameter name -> list of values, every combination is a job
+    # log_dir: the runs of each job are streamed to log_dir/job_<index> instead of being kept in memory
+    # profile: the phases of the runs are timed, see Environment.enableProfiling
+    names = list(params)
+    jobs = []
+    for preset, agent_type, values in itertools.product(presets, agent_types, itertools.product(*params.values())):
+        for seed in seeds:
+            jobs.append({"preset": preset, "seed": seed, "agent": agent_type, "params": dict(zip(names, values)),
+                         "phases": phases, "steps": steps,
+                         "log_dir": None if log_dir is None else os.path.join(log_dir, f"job_{len(jobs)}"),
+                         "profile": profile})
+    return jobs
+
+
+def seedAll(seed):
+    rd.seed(seed)
+    np.random.seed(seed)
+    try:
+        import torch  # type: ignore
+        torch.manual_seed(seed)
+    except ImportError:
+        pass
+
+
+def loadAgent(env, agent_type, params, steps):
+    # replaces the agents of the preset by the requested type, then applies the hyper-parameters
+    for agent in env.agents:
+        if agent_type == "dqn":
+            agent.loadDQNAgent(steps, params.get("agent_type", "std"))
+        elif agent_type == "optimal":
+            agent.loadOptimalAgent(steps)
+        elif agent_type == "normative":
+            agent.loadNormativeAgent(steps)
+        elif agent_type != "default":
+            raise ValueError(f"Unknown agent type: {agent_type}. Known types: {AGENT_TYPES}")
+        for name, value in params.items():
+            if name == "agent_type":
+                if agent_type != "dqn":
+                    raise ValueError(f"The hyper-parameter 'agent_type' is only for the dqn agents, not '{agent_type}'.")
+                continue
+            if not hasattr(agent.agent, name):
+                raise ValueError(f"Unknown hyper-parameter '{name}' for agent '{agent.name}'.")
+            setattr(agent.agent, name, value)
+
+
+def setSteps(env, steps):
+    # the tabular agents decay their exploration over the steps of the run, the DQN agent reads env.steps
+    env.setSteps(steps)
+    for agent in env.agents:
+        if agent.isTabular():
+            agent.setSteps(steps)
+
+
+def runJob(job, quiet=True):
+    if quiet:  # the progress bars and run infos of the workers would interleave
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            return runJob(job, False)
+
+    seedAll(job["seed"])
+    env = Environment()
+    env.setLogDirectory(job.get("log_dir"))
+    if job.get("profile"):
+        env.enableProfiling()
+    env.loadPreset(job["preset"], reset_agent=True)
+    if job["steps"] is not None:
+        setSteps(env, job["steps"])
+    if job["agent"] != "default" or job["params"]:
+        loadAgent(env, job["agent"], job["params"], env.steps)
+        env.loadPreset(job["preset"], reset_agent=False)  # gives the actions to the new agents
+        for agent in env.agents:
+            if agent.isTabular() and not agent.agent.actions:  # presets made for the DQN agent
+                agent.setActions(env.getActions())
+
+    for i, phase in enumerate(job["phases"]):
+        if i > 0:
+            env.setOptimal(phase.get("optimal", False))
+            env.setLearning(phase.get("learning", True))
+            if "steps" in phase:
+                setSteps(env, phase["steps"])
+            env.loadPreset(job["preset"], reset_agent=False)
+        env.run(display=False, run_title=phase.get("title", ""))
+
+    return {"job": job, "historic": env.historic}
+
+
+def runJobs(jobs, workers=None, quiet=True):
+    # results are returned in the order of the jobs
+    if workers == 1:
+        return [runJob(job, quiet) for job in jobs]
+    with multiprocessing.Pool(workers) as pool:
+        return pool.starmap(runJob, [(job, quiet) for job in jobs], chunksize=1)
+
+
+def summarize(results):
+    # mean total signals of the last run of each job, grouped by configuration
+    groups = {}
+    for result in results:
+        job = result["job"]
+        key = (job["preset"], job["agent"], json.dumps(job["params"], sort_keys=True))
+        last = result["historic"][-1]
+        totals = last.get("totals")  # kept by the streamed runs
+        if totals is None:
+            totals = {}
+            for log in last["logs"]:
+                for k, v in log.items():
+                    totals[k] = totals.get(k, 0) + v
+        groups.setdefault(key, []).append(totals)
+    summary = []
+    for (preset, agent_type, params), runs in groups.items():
+        means = {k: sum(run.get(k, 0) for run in runs) / len(runs) for k in runs[0]}
+        summary.append({"preset": preset, "agent": agent_type, "params": json.loads(params),
+                        "seeds": len(runs), "mean": means})
+    return summary
+
+
+def save(results, path):
+    # streamed logs are saved as the path of their directory, see RunLog.load
+    with open(path, 'w') as file:
+        json.dump(results, file, default=lambda obj: obj.path if isinstance(obj, RunLog) else float(obj))
+
+
+def load(path):
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def parseParam(text):
+    # name=v1,v2,... with values parsed as JSON when possible
+    name, values = text.split("=", 1)
+    parsed = []
+    for value in values.split(","):
+        try:
+            parsed.append(json.loads(value))
+        except json.JSONDecodeError:
+            parsed.append(value)
+    return name, parsed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run a grid of Pinocchio experiments in parallel.")
+    parser.add_argument("--presets", nargs="+", default=["taxi"])
+    parser.add_argument("--seeds", type=int, default=20, help="number of seeds per configuration")
+    parser.add_argument("--first-seed", type=int, default=0)
+    parser.add_argument("--agents", nargs="+", default=["default"], choices=AGENT_TYPES)
+    parser.add_argument("--param", action="append", default=[], help="hyper-parameter grid, e.g. alpha=0.05,0.1")
+    parser.add_argument("--steps", type=int, default=None, help="training steps, the preset's by default")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", default="results.json")
+    parser.add_argument("--log-dir", default=None, help="stream the steps of the runs there instead of keeping them")
+    parser.add_argument("--profile", action="store_true", help="time the phases of the steps")
+    args = parser.parse_args()
+
+    params = dict(parseParam(param) for param in args.param)
+    seeds = range(args.first_seed, args.first_seed + args.seeds)
+    jobs = makeJobs(args.presets, seeds, args.agents, params, steps=args.steps, log_dir=args.log_dir,
+                    profile=args.profile)
+    print(f"{len(jobs)} jobs on {args.workers} workers")
+
+    results = runJobs(jobs, args.workers)
+    save(results, args.output)
+    for line in summarize(results):
+        print(line)
@@ -0,0 +1,172 @@
+# N independent copies of a loaded preset, stepped together with the semantics of Environment.doAction_2
+# each copy is a row of the arrays, each agent a column
+
+import numpy as np
+
+from environment import MOVEMENTS, MOVEMENT_INDEX, ROAD, SPEED_REWARDS, BUMP_REWARD
+
+MAX_BITS = 63  # items and flags are stored as int64 bitsets
+
+
+class VectorEnvironment:
+
+    def __init__(self, env, n, actions=None):
+        # env: Environment with a loaded preset, every copy starts from its current state
+        # actions: action list of the agents, the taxi actions by default
+        self.n = n
+        self.width = env.width
+        self.height = env.height
+        self.timeout = env.timeout
+        self.types = env.types.reshape(-1).copy()
+        self.next_cells = env.next_cells
+        self.bumps = env.bumps
+        self.agent_names = [agent.name for agent in env.agents]
+
+        if actions is None:
+            actions = [(movement, speed) for movement in MOVEMENTS for speed in ["slow", "fast"]]
+        self.actions = actions
+        self.action_moves = np.array([MOVEMENT_INDEX.get(action[0], -1) for action in actions])
+        self.action_rewards = np.array([SPEED_REWARDS.get(action[1], 0) for action in actions], dtype=float)
+
+        self.items = []  # bit position -> inventory item
+        self.flags = ["road", "pavement", "collision"]  # bit position -> flag, global flags included
+        for obj in env.objects.values():
+            for item in obj["inv_add"] + obj["inv_rem"] + [env.getCondition(c)[0] for c in obj["condition"]]:
+                if item not in self.items:
+                    self.items.append(item)
+            for flag in obj["flags"] + obj["global_flags"]:
+                if flag not in self.flags:
+                    self.flags.append(flag)
+        for agent in env.agents:
+            for item in agent.getInventory():
+                if item not in self.items:
+                    self.items.append(item)
+        if len(self.items) > MAX_BITS or len(self.flags) > MAX_BITS:
+            raise ValueError(f"Too many items or flags, at most {MAX_BITS} of each are supported.")
+
+        # objects, in the order they are processed by handleObjectsOnPosition
+        self.object_names = list(env.objects)
+        objects = list(env.objects.values())
+        self.object_cells = np.array([obj["pos"][0] + obj["pos"][1] * self.width for obj in objects], dtype=np.int64)
+        self.object_rewards = np.array([obj["reward"] for obj in objects], dtype=float)
+        self.object_add = [self.itemMask(obj["inv_add"]) for obj in objects]
+        self.object_rem = [self.itemMask(obj["inv_rem"]) for obj in objects]
+        self.object_required = [self.itemMask([c for c in obj["condition"] if not env.getCondition(c)[1]])
+                                for obj in objects]
+        self.object_forbidden = [self.itemMask([env.getCondition(c)[0] for c in obj["condition"]
+                                                if env.getCondition(c)[1]]) for obj in objects]
+        self.object_flags = [self.flagMask(obj["flags"]) for obj in objects]
+        self.object_global_flags = [self.flagMask(obj["global_flags"]) for obj in objects]
+        self.object_permanent = [obj["permanent"] for obj in objects]
+
+        # initial state of every copy
+        self.start_cells = np.array([env.pos[name][0] + env.pos[name][1] * self.width for name in self.agent_names],
+                                    dtype=np.int64)
+        self.start_inventory = np.array([self.itemMask(agent.getInventory()) for agent in env.agents], dtype=np.int64)
+
+        self.cells = np.zeros((n, len(self.agent_names)), dtype=np.int64)  # x + y * width, as Environment.getState
+        self.inventory = np.zeros((n, len(self.agent_names)), dtype=np.int64)
+        self.present = np.zeros((n, len(self.object_names)), dtype=bool)  # objects not removed yet
+        self.iterations = np.zeros(n, dtype=np.int64)
+        self.last_actions = np.full((n, len(self.agent_names)), -1, dtype=np.int64)
+        self.reset()
+
+    def itemMask(self, items):
+        mask = 0
+        for item in items:
+            mask |= 1 << self.items.index(item)
+        return mask
+
+    def flagMask(self, flags):
+        mask = 0
+        for flag in flags:
+            mask |= 1 << self.flags.index(flag)
+        return mask
+
+    def decodeFlags(self, mask):
+        return [flag for i, flag in enumerate(self.flags) if int(mask) >> i & 1]
+
+    def decodeItems(self, mask):
+        return [item for i, item in enumerate(self.items) if int(mask) >> i & 1]
+
+    def hasFlag(self, flags, flag):
+        # boolean array of the flag masks containing flag, to build the facts of a batched judgement
+        if flag not in self.flags:
+            return np.zeros(np.shape(flags), dtype=bool)
+        return flags & (1 << self.flags.index(flag)) != 0
+
+    def hasItem(self, item):
+        # boolean array of the inventories containing item, shape (n, agents)
+        if item not in self.items:
+            return np.zeros(self.inventory.shape, dtype=bool)
+        return self.inventory & (1 << self.items.index(item)) != 0
+
+    def reset(self, copies=None):
+        # copies: boolean mask of the copies to reset, all of them by default
+        if copies is None:
+            copies = np.ones(self.n, dtype=bool)
+        self.cells[copies] = self.start_cells
+        self.inventory[copies] = self.start_inventory
+        self.present[copies] = True
+        self.iterations[copies] = 0
+        self.last_actions[copies] = -1
+
+    def getPositions(self):
+        # positions as [x, y], shape (n, agents, 2)
+        return np.stack([self.cells % self.width, self.cells // self.width], axis=-1)
+
+    def step(self, actions):
+        # actions: action indices, shape (n, agents), or (n,) with a single agent
+        # returns the rewards and the flag masks of each agent, shape (n, agents), and the copies that ended
+        actions = np.asarray(actions, dtype=np.int64).reshape(self.n, len(self.agent_names))
+        rewards = np.zeros(actions.shape, dtype=float)
+        flags = np.zeros(actions.shape, dtype=np.int64)
+        global_flags = np.zeros(self.n, dtype=np.int64)
+        road, pavement, collision = (1 << self.flags.index(flag) for flag in ["road", "pavement", "collision"])
+
+        # the agents act sequentially, as in Environment.step
+        for a in range(len(self.agent_names)):
+            action = actions[:, a]
+            self.last_actions[:, a] = action
+            cells = self.cells[:, a]
+            moves = self.action_moves[action]
+            rewards[:, a] += self.action_rewards[action]
+
+            moving = moves >= 0
+            targets = np.where(moving, self.next_cells[cells, np.maximum(moves, 0)], cells)
+            bumped = moving & self.bumps[cells, np.maximum(moves, 0)]
+            rewards[:, a] += np.where(bumped, BUMP_REWARD, 0)
+            self.cells[:, a] = targets
+
+            # objects on the new position
+            inventory = self.inventory[:, a]
+            for j in range(len(self.object_names)):
+                applied = self.present[:, j] & (targets == self.object_cells[j])
+                applied &= (inventory & self.object_required[j]) == self.object_required[j]
+                applied &= (inventory & self.object_forbidden[j]) == 0
+                inventory = np.where(applied, (inventory | self.object_add[j]) & ~self.object_rem[j], inventory)
+                rewards[:, a] += np.where(applied, self.object_rewards[j], 0)
+                flags[:, a] |= np.where(applied, self.object_flags[j], 0)
+                global_flags |= np.where(applied, self.object_global_flags[j], 0)
+                if not self.object_permanent[j]:
+                    self.present[:, j] &= ~applied
+            self.inventory[:, a] = inventory
+
+            flags[:, a] |= np.where(self.types[targets] == ROAD, road, pavement)
+            others = np.zeros(self.n, dtype=bool)
+            for b in range(len(self.agent_names)):
+                if b != a:
+                    others |= self.cells[:, b] == targets
+            flags[:, a] |= np.where(others, collision, 0)
+
+        # global flags are given to all the agents
+        flags |= global_flags[:, None]
+        ends = global_flags & self.flagMask(["end"]) != 0 if "end" in self.flags else np.zeros(self.n, dtype=bool)
+        return rewards, flags, ends
+
+    def advance(self, ends):
+        # counts the step and resets the copies that ended or timed out, as Environment.run
+        self.iterations += 1
+        done = ends | (self.iterations >= self.timeout)
+        self.reset(done)
+        return done
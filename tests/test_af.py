@@ -0,0 +1,92 @@
+import itertools
+import os
+import random as rd
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from af import AF, IN, OUT, IncrementalGrounded, SEMANTICS
+
+
+def randomAF(arguments, attacks, seed):
+    rd.seed(seed)
+    af = AF()
+    names = [f"a{i}" for i in range(arguments)]
+    for name in names:
+        af.addArgument(name)
+    for attack in {(rd.choice(names), rd.choice(names)) for _ in range(attacks)}:
+        af.addAttack(attack)
+    return af
+
+
+def bruteForceExtensions(af):
+    # every extension of each semantics, by enumeration of the subsets of arguments
+    args = af.arguments
+    attacks = set(af.getAttacks())
+
+    def attacked(subset):
+        return {b for a, b in attacks if a in subset}
+
+    def defends(subset, arg):
+        return all(attacker in attacked(subset) for attacker in af.getInAttack(arg))
+
+    complete, stable = [], []
+    for n in range(len(args) + 1):
+        for subset in map(frozenset, itertools.combinations(args, n)):
+            if subset & attacked(subset):
+                continue  # not conflict-free
+            if subset == {arg for arg in args if defends(subset, arg)}:
+                complete.append(subset)
+            if attacked(subset) | subset == set(args):
+                stable.append(subset)
+    preferred = [e for e in complete if not any(e < other for other in complete)]
+    grounded = [min(complete, key=len)]
+    return {"grounded": grounded, "complete": complete, "preferred": preferred, "stable": stable}
+
+
+def test_semantics_match_brute_force():
+    for seed in range(300):
+        af = randomAF(rd.Random(seed).randint(1, 7), rd.Random(seed).randint(0, 14), seed)
+        expected = bruteForceExtensions(af)
+        for semantics in SEMANTICS:
+            extensions = {frozenset(extension) for extension in af.computeExtensions(semantics)}
+            assert extensions == set(expected[semantics]), (seed, semantics, af.getAttacks())
+            for arg in af.arguments:
+                credulous = any(arg in extension for extension in expected[semantics])
+                skeptical = all(arg in extension for extension in expected[semantics])
+                assert af.isAccepted(arg, semantics, "credulous") == credulous, (seed, semantics, arg)
+                assert af.isAccepted(arg, semantics, "skeptical") == skeptical, (seed, semantics, arg)
+
+
+def test_searchLabellings_are_complete():
+    for seed in range(100):
+        af = randomAF(6, 10, seed)
+        expected = set(bruteForceExtensions(af)["complete"])
+        found = [frozenset(af.getInArguments(labels)) for labels in af.searchLabellings()]
+        assert len(found) == len(set(found))
+        assert set(found) == expected, seed
+
+
+def restrict(af, active):
+    # the AF of the active arguments only
+    restricted = AF()
+    for arg in active:
+        restricted.addArgument(arg)
+    for a, b in af.getAttacks():
+        if a in active and b in active:
+            restricted.addAttack((a, b))
+    return restricted
+
+
+def test_incremental_grounded_matches_groundedLabelling():
+    for seed in range(100):
+        af = randomAF(8, 14, seed)
+        inc, index = IncrementalGrounded.fromAF(af)
+        for _ in range(30):
+            active = [arg for arg in af.arguments if rd.random() < 0.7]
+            mask = sum(index[arg] for arg in active)
+            labels = restrict(af, active).groundedLabelling()
+            inn = sum(index[arg] for arg in active if labels[arg] == IN)
+            out = sum(index[arg] for arg in active if labels[arg] == OUT)
+            assert inc.update(mask) == inn, (seed, active, af.getAttacks())
+            assert inc.out == out, (seed, active, af.getAttacks())
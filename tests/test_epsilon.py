@@ -0,0 +1,34 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from epsilon import FactExtractor
+from judgement import FactIndex
+
+
+def makeExtractor():
+    index = FactIndex()
+    facts = {"wall": lambda state, flags: state["grid"][0] == 1,
+             "home": lambda state, flags: state["pos"]["agent"] == [0, 0]}
+    deps = {"wall": ["grid"], "home": ["pos"]}
+    return FactExtractor(facts, deps, [], index), index
+
+
+def test_plain_state_mutated_in_place():
+    # without versions, the changes of the state cannot be known and every fact is evaluated
+    extractor, index = makeExtractor()
+    state = {"grid": [0], "pos": {"agent": [0, 0]}}
+    assert index.decode(extractor.extract(state, [])) == ["home"]
+    state["grid"][0] = 1
+    state["pos"]["agent"][0] = 1
+    assert index.decode(extractor.extract(state, [])) == ["wall"]
+
+
+def test_versioned_state():
+    extractor, index = makeExtractor()
+    state = {"grid": [0], "pos": {"agent": [0, 0]}, "versions": {"grid": 0, "pos": 0}}
+    assert index.decode(extractor.extract(state, [])) == ["home"]
+    state["pos"] = {"agent": [1, 0]}
+    state["versions"] = {"grid": 0, "pos": 1}
+    assert index.decode(extractor.extract(state, [])) == []
@@ -0,0 +1,57 @@
+import os
+import random as rd
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from af import SEMANTICS
+from environment import Environment
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")  # the presets load their maps from src/environments
+PRESETS = ["mini_taxi", "taxi", "pacman", "adam"]
+
+
+def randomSteps(env, agent, steps, seed):
+    # states and flags reached by random actions, judged as in Environment.step
+    rd.seed(seed)
+    actions = env.getActions()
+    for _ in range(steps):
+        action = rd.choice(actions)
+        agent.setLastAction(action)
+        signals, flags, global_flags = env.doAction(agent, action)
+        yield env.getStateDict(1), env.mergeFlags(flags, global_flags)
+        env.iterations += 1
+        if env.iterations >= env.timeout or "end" in global_flags:
+            env.loadPreset(env.loadedPreset, reset_agent=False)
+            env.iterations = 0
+
+
+def checkCompiled(env, agent, steps, seed):
+    for state, flags in randomSteps(env, agent, steps, seed):
+        override = {name: rd.random() < 0.5 for name in agent.getNormNames() if rd.random() < 0.2}
+        agent.override = override
+        compiled = agent.compiled.evaluate(agent.compiled.epsilon(state, flags), override)
+        assert compiled == agent.judgeAF(state, flags), (state, flags, override)
+
+
+def test_compiled_matches_judgeAF(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    for preset in PRESETS:
+        env = Environment()
+        env.loadPreset(preset)
+        agent = env.agents[-1]
+        agent.compile()
+        checkCompiled(env, agent, 300, 0)
+
+
+def test_compiled_matches_judgeAF_with_random_semantics(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    rd.seed(1)
+    for preset in PRESETS:
+        env = Environment()
+        env.loadPreset(preset)
+        agent = env.agents[-1]
+        for rnorm in agent.norms:
+            rnorm.setSemantics(rd.choice(SEMANTICS), rd.choice(["skeptical", "credulous"]))
+        agent.compile()
+        checkCompiled(env, agent, 200, 1)
@@ -0,0 +1,84 @@
+import os
+import random as rd
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from qagent import QAgent, STORAGES
+
+
+def makeAgent(storage, trace_decay=0.9):
+    agent = QAgent("test", storage)
+    agent.setActions(["a", "b"])
+    agent.addQFunction("R")
+    agent.gamma = 0.9
+    agent.trace_decay = trace_decay
+    return agent
+
+
+def test_traces_cut_on_exploratory_action():
+    # the TD error of an exploratory action is not given to the earlier greedy pairs
+    for storage in STORAGES:
+        agent = makeAgent(storage)
+        agent.explored = False
+        agent.updateQFunctions("s0", "a", {"R": 0}, "s1")
+        agent.explored = True
+        agent.updateQFunctions("s1", "b", {"R": 100}, "s2")
+        assert agent.getQValues("R", "s0") == {"a": 0.0, "b": 0.0}
+        assert agent.getQValues("R", "s1")["b"] == agent.roundValue(agent.alpha * 100)
+
+
+def test_traces_follow_greedy_actions():
+    for storage in STORAGES:
+        agent = makeAgent(storage)
+        agent.explored = False
+        agent.updateQFunctions("s0", "a", {"R": 0}, "s1")
+        agent.updateQFunctions("s1", "b", {"R": 100}, "s2")
+        assert agent.getQValues("R", "s0")["a"] > 0
+
+
+def randomTransitions(n, seed):
+    rng = rd.Random(seed)
+    states = [f"s{i}" for i in range(6)]
+    for _ in range(n):
+        yield rng.choice(states), rng.choice(["a", "b"]), {"R": rng.randint(-5, 5)}, rng.choice(states), \
+            rng.random() < 0.3, rng.random() < 0.1
+
+
+def test_short_traces_match_sequential_updates():
+    # traces decaying below the threshold after one step give the one-step update of each transition
+    for storage in STORAGES:
+        traced = makeAgent(storage, trace_decay=0.01)
+        sequential = makeAgent(storage, trace_decay=0)
+        for state, action, signals, next_state, explored, done in randomTransitions(500, 0):
+            traced.explored = explored
+            traced.updateQFunctions(state, action, signals, next_state, done=done)
+            sequential.updateQFunctions(state, action, signals, next_state, done=done)
+        for state in ["s0", "s1", "s2", "s3", "s4", "s5"]:
+            assert traced.getQValues("R", state) == sequential.getQValues("R", state), (storage, state)
+
+
+def test_traces_match_sequential_updates_of_eligible_pairs():
+    # Watkins' Q(lambda) written as a sequence of one-step updates of every eligible pair
+    for storage in STORAGES:
+        agent = makeAgent(storage)
+        agent.rounding = None
+        Q = {}
+        traces = {}
+        for state, action, signals, next_state, explored, done in randomTransitions(500, 1):
+            agent.explored = explored
+            agent.updateQFunctions(state, action, signals, next_state, done=done)
+
+            delta = signals["R"] + agent.gamma * max(Q.get((next_state, a), 0) for a in ["a", "b"]) \
+                - Q.get((state, action), 0)
+            if explored:
+                traces = {}
+            traces[(state, action)] = 1.0
+            for pair, e in traces.items():
+                Q[pair] = Q.get(pair, 0) + agent.alpha * e * delta
+            decay = agent.gamma * agent.trace_decay
+            traces = {} if done else {pair: e * decay for pair, e in traces.items() if e * decay >= agent.trace_threshold}
+        for (state, action), value in Q.items():
+            assert agent.getQValues("R", state)[action] == pytest.approx(value), (storage, state, action)
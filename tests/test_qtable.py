@@ -0,0 +1,28 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from qtable import QTable, SELECTION_METHODS
+
+
+def makeTable():
+    table = QTable(["a", "b", "c"])
+    table.addQFunction("V")
+    table.addQFunction("R")
+    return table
+
+
+def test_select_empty_table():
+    table = makeTable()
+    for method in SELECTION_METHODS:
+        mask, none = table.select(table.rows(["s0", "s1"]), ["V", "R"], method)
+        assert mask.shape == (2, 3) and mask.all()
+        assert none.all()
+
+
+def test_select_unknown_state():
+    table = makeTable()
+    table.row("s0")
+    mask, none = table.select(table.rows(["s1"]), ["V", "R"])
+    assert mask.all() and none.all()
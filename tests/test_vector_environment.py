@@ -0,0 +1,56 @@
+import os
+import random as rd
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from environment import Environment
+from vector_environment import VectorEnvironment
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")  # the presets load their maps from src/environments
+PRESETS = ["mini_taxi", "taxi"]  # the presets acting with doAction_2
+
+
+def stepCopy(env, actions):
+    # one step of the copy with doAction_2, the agents acting sequentially as in Environment.step
+    rewards, all_flags, all_gflags = [], [], []
+    for agent, action in zip(env.agents, actions):
+        agent.setLastAction(action)
+        signals, flags, global_flags = env.doAction(agent, action)
+        rewards.append(signals["R"])
+        all_flags.append(flags)
+        all_gflags.extend(global_flags)
+    env.iterations += 1
+    done = env.iterations >= env.timeout or "end" in all_gflags
+    return rewards, [env.mergeFlags(flags, all_gflags) for flags in all_flags], "end" in all_gflags, done
+
+
+def test_vector_environment_matches_doAction_2(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    rd.seed(0)
+    for preset in PRESETS:
+        envs = []
+        for _ in range(8):
+            env = Environment()
+            env.loadPreset(preset)
+            envs.append(env)
+        vector = VectorEnvironment(envs[0], len(envs))
+        for _ in range(200):
+            indices = [[rd.randrange(len(vector.actions)) for _ in env.agents] for env in envs]
+            rewards, flags, ends = vector.step(indices)
+            done = vector.advance(ends)
+            positions = vector.getPositions()
+            for i, env in enumerate(envs):
+                copy_rewards, copy_flags, copy_end, copy_done = stepCopy(env, [vector.actions[k] for k in indices[i]])
+                assert np.allclose(rewards[i], copy_rewards), (preset, i)
+                for a in range(len(env.agents)):
+                    assert set(vector.decodeFlags(flags[i, a])) == set(copy_flags[a]), (preset, i, a)
+                assert ends[i] == copy_end and done[i] == copy_done, (preset, i)
+                if copy_done:
+                    env.loadPreset(preset, reset_agent=False)
+                    env.iterations = 0
+                for a, agent in enumerate(env.agents):
+                    assert list(positions[i, a]) == list(env.pos[agent.name]), (preset, i, a)
+                    assert set(vector.decodeItems(vector.inventory[i, a])) == set(agent.getInventory()), (preset, i, a)